@@ -4,19 +4,31 @@ BaixaFy Interface - Baseada no baixar.py original
 Interface gráfica completa com CustomTkinter para baixar músicas do Spotify.
 """
 
-import customtkinter as ctk
-import tkinter as tk
-from tkinter import messagebox, filedialog
 import threading
+import queue
 import os
 import sys
 import subprocess
+import sqlite3
 from pathlib import Path
 import time
 
-# Configuração do tema
-ctk.set_appearance_mode("dark")
-ctk.set_default_color_theme("green")
+from baixafy_motor import (
+    FIM_INTERROMPIDO, PERFIS, MotorDownloads, carregar_config, chave_arquivo,
+    encoder_disponivel, escolher_perfil, gravar_cache, ler_cache, localizar_ffmpeg,
+    localizar_spotdl, sondar_ffmpeg,
+)
+
+# Em plataformas "spawn" os processos dos pools reimportam este arquivo como
+# __mp_main__; eles só usam o motor, então pulam o Tk e o tema
+if __name__ != "__mp_main__":
+    import customtkinter as ctk
+    import tkinter as tk
+    from tkinter import messagebox, filedialog
+
+    # Configuração do tema
+    ctk.set_appearance_mode("dark")
+    ctk.set_default_color_theme("green")
 
 class BaixaFyInterface:
     """Interface principal do BaixaFy baseada no baixar.py original."""
@@ -26,10 +38,18 @@ class BaixaFyInterface:
         self.root = ctk.CTk()
         self.pasta_destino = self._obter_pasta_musicas()
         self.baixando = False
-        self.processo_atual = None
+        self.job_atual = None
+        self.total_musicas = 0
+        self.musicas_feitas = 0
+        self.pausado = False
+        self.ffmpeg_info = None
+        self.spotdl_caminho = None
+        self.config = carregar_config()
+        self.motor = MotorDownloads(self.config)
         
         self._configurar_janela()
         self._criar_interface()
+        self._verificar_ffmpeg()
         self._verificar_spotdl()
     
     def _obter_pasta_musicas(self) -> str:
@@ -123,7 +143,7 @@ class BaixaFyInterface:
         pasta_label.pack(anchor="w", padx=20, pady=(20, 10))
         
         pasta_frame = ctk.CTkFrame(pasta_section, fg_color="transparent")
-        pasta_frame.pack(fill="x", padx=20, pady=(0, 20))
+        pasta_frame.pack(fill="x", padx=20, pady=(0, 10))
         
         self.pasta_entry = ctk.CTkEntry(
             pasta_frame,
@@ -143,6 +163,47 @@ class BaixaFyInterface:
         )
         btn_pasta.pack(side="right")
         
+        self.perfil_menu = ctk.CTkOptionMenu(
+            pasta_frame,
+            values=[p["nome"] for p in PERFIS],
+            width=130,
+            height=40,
+            font=ctk.CTkFont(size=12)
+        )
+        self.perfil_menu.pack(side="right", padx=(0, 10))
+        
+        # Ferramentas da biblioteca (agem sobre a pasta escolhida)
+        biblioteca_frame = ctk.CTkFrame(pasta_section, fg_color="transparent")
+        biblioteca_frame.pack(fill="x", padx=20, pady=(0, 20))
+        
+        self.botoes_biblioteca = []
+        for texto, comando in (("📚 Indexar", self._indexar_pasta),
+                               ("📥 Adotar", self._adotar_pasta),
+                               ("👯 Duplicatas", self._procurar_duplicatas)):
+            botao = ctk.CTkButton(
+                biblioteca_frame,
+                text=texto,
+                width=120,
+                height=32,
+                font=ctk.CTkFont(size=12),
+                command=comando
+            )
+            botao.pack(side="left", padx=(0, 10))
+            self.botoes_biblioteca.append(botao)
+        
+        self.busca_entry = ctk.CTkEntry(
+            biblioteca_frame,
+            height=32,
+            placeholder_text="🔍 Buscar na biblioteca (título, artista, álbum, playlist)",
+            font=ctk.CTkFont(size=12)
+        )
+        self.busca_entry.pack(side="left", fill="x", expand=True)
+        self.busca_entry.bind("<Return>", lambda evento: self._buscar_biblioteca())
+        if self.motor.biblioteca is None:
+            # Índice não abriu (o motor já avisou no log)
+            for widget in self.botoes_biblioteca + [self.busca_entry]:
+                widget.configure(state="disabled")
+        
         # Área de log/progresso
         log_section = ctk.CTkFrame(main_frame)
         log_section.pack(fill="both", expand=True, pady=(0, 20))
@@ -160,7 +221,12 @@ class BaixaFyInterface:
             height=200,
             font=ctk.CTkFont(size=11)
         )
-        self.log_textbox.pack(fill="both", expand=True, padx=20, pady=(0, 20))
+        self.log_textbox.pack(fill="both", expand=True, padx=20, pady=(0, 10))
+        
+        # Progresso do job (músicas concluídas / total)
+        self.progress_bar = ctk.CTkProgressBar(log_section, height=10)
+        self.progress_bar.pack(fill="x", padx=20, pady=(0, 20))
+        self.progress_bar.set(0)
         
         # Botões de ação
         buttons_frame = ctk.CTkFrame(main_frame, fg_color="transparent")
@@ -192,6 +258,34 @@ class BaixaFyInterface:
         )
         self.btn_parar.pack(side="right")
         
+        self.btn_drenar = ctk.CTkButton(
+            buttons_frame,
+            text="⏭️ Finalizar",
+            height=55,
+            width=120,
+            font=ctk.CTkFont(size=16, weight="bold"),
+            fg_color="#6c757d",
+            hover_color="#5a6268",
+            corner_radius=30,
+            command=self._drenar_download,
+            state="disabled"
+        )
+        self.btn_drenar.pack(side="right", padx=(0, 10))
+        
+        self.btn_pausar = ctk.CTkButton(
+            buttons_frame,
+            text="⏸️ Pausar",
+            height=55,
+            width=120,
+            font=ctk.CTkFont(size=16, weight="bold"),
+            fg_color="#17a2b8",
+            hover_color="#138496",
+            corner_radius=30,
+            command=self._pausar_download,
+            state="disabled"
+        )
+        self.btn_pausar.pack(side="right", padx=(0, 10))
+        
         # Status bar
         self.status_label = ctk.CTkLabel(
             self.root,
@@ -201,15 +295,77 @@ class BaixaFyInterface:
         )
         self.status_label.pack(pady=10)
     
-    def _verificar_spotdl(self):
-        """Verifica se SpotDL está funcionando."""
+    def _verificar_ffmpeg(self):
+        """Sonda o ffmpeg em segundo plano (resultado fica em cache)."""
         def verificar():
             try:
-                result = subprocess.run(['spotdl', '--version'], 
+                ffmpeg = localizar_ffmpeg()
+                if not ffmpeg:
+                    self.root.after(0, self._log, "⚠️ ffmpeg não encontrado, o spotdl usará o próprio")
+                    return
+                info = sondar_ffmpeg(ffmpeg)
+                self.root.after(0, self._ffmpeg_ok, info)
+            except Exception as e:
+                self.root.after(0, self._log, f"⚠️ Erro ao verificar ffmpeg: {e}")
+        
+        thread = threading.Thread(target=verificar)
+        thread.daemon = True
+        thread.start()
+    
+    def _ffmpeg_ok(self, info: dict):
+        """ffmpeg sondado: filtra perfis que ele consegue gerar."""
+        self.ffmpeg_info = info
+        disponiveis = [p["nome"] for p in PERFIS if encoder_disponivel(info, p)]
+        if disponiveis:
+            self.perfil_menu.configure(values=disponiveis)
+            if self.perfil_menu.get() not in disponiveis:
+                self.perfil_menu.set(disponiveis[0])
+        self._log(f"🎚️ ffmpeg {info['versao']} ({len(info['encoders'])} encoders de áudio)")
+    
+    def _perfil_selecionado(self) -> dict:
+        """Perfil escolhido na interface, ajustado ao ffmpeg disponível."""
+        nome = self.perfil_menu.get()
+        if self.ffmpeg_info:
+            perfil = escolher_perfil(self.ffmpeg_info, nome)
+            if perfil:
+                return perfil
+        return next((dict(p) for p in PERFIS if p["nome"] == nome), dict(PERFIS[0]))
+    
+    def _verificar_spotdl(self, forcar: bool = False):
+        """Verifica se SpotDL está funcionando.
+        
+        O resultado fica em cache indexado pelo executável do spotdl; só
+        roda `spotdl --version` de novo se o arquivo mudar ou se `forcar`
+        for pedido (ex.: depois de um download com erro).
+        """
+        spotdl = localizar_spotdl()
+        if spotdl:
+            try:
+                chave = chave_arquivo(spotdl)
+            except OSError:
+                chave = None
+            cache = ler_cache("spotdl_cache.json")
+            if not forcar and chave and cache.get("chave") == chave:
+                self.spotdl_caminho = spotdl
+                self._spotdl_ok(cache["versao"])
+                return
+        
+        def verificar():
+            try:
+                if not spotdl:
+                    self.root.after(0, self._spotdl_erro, "SpotDL não encontrado")
+                    return
+                result = subprocess.run([spotdl, '--version'], 
                                       capture_output=True, text=True, timeout=10)
                 if result.returncode == 0:
                     versao = result.stdout.strip()
-                    self.root.after(0, self._spotdl_ok, versao)
+                    if chave:
+                        gravar_cache("spotdl_cache.json", {"chave": chave, "versao": versao})
+                    self.spotdl_caminho = spotdl
+                    if forcar:
+                        self.root.after(0, self._log, f"🔍 SpotDL revalidado: {versao}")
+                    else:
+                        self.root.after(0, self._spotdl_ok, versao)
                 else:
                     self.root.after(0, self._spotdl_erro, "SpotDL não encontrado")
             except Exception as e:
@@ -223,9 +379,15 @@ class BaixaFyInterface:
         """SpotDL funcionando."""
         self._log(f"✅ SpotDL instalado: {versao}")
         self._atualizar_status("✅ SpotDL funcionando! Pronto para baixar.")
+        
+        # Aquece um worker para o primeiro download não pagar o import do spotdl
+        self.motor.spotdl_cli = self.spotdl_caminho
+        self.motor.aquecer()
     
     def _spotdl_erro(self, erro: str):
         """Erro no SpotDL."""
+        gravar_cache("spotdl_cache.json", {})
+        self.spotdl_caminho = None
         self._log(f"❌ Erro no SpotDL: {erro}")
         self._atualizar_status("❌ Erro no SpotDL. Verifique instalação.")
         
@@ -250,6 +412,57 @@ class BaixaFyInterface:
             self.pasta_entry.insert(0, pasta)
             self._log(f"📁 Pasta alterada para: {pasta}")
     
+    def _buscar_biblioteca(self):
+        """Mostra no log as músicas da biblioteca que casam com a busca."""
+        texto = self.busca_entry.get().strip()
+        if not texto:
+            return
+        try:
+            resultados = self.motor.biblioteca.buscar(texto)
+        except sqlite3.Error as e:
+            self._log(f"❌ Erro na busca: {e}")
+            return
+        self._log(f"🔍 {len(resultados)} resultado(s) para \"{texto}\"")
+        for caminho, titulo, artistas, album in resultados:
+            if titulo:
+                self._log(f"   🎵 {artistas} - {titulo} ({album or 'sem álbum'}) → {caminho}")
+            else:
+                self._log(f"   🎵 {caminho}")
+    
+    def _pasta_biblioteca(self):
+        """Pasta escolhida para uma tarefa da biblioteca (None se inválida).
+
+        Desabilita os botões da biblioteca até o motor avisar o fim.
+        """
+        pasta = self.pasta_entry.get().strip()
+        if not pasta or not os.path.isdir(pasta):
+            messagebox.showerror("Pasta inválida", "Escolha uma pasta existente!")
+            return None
+        for botao in self.botoes_biblioteca:
+            botao.configure(state="disabled")
+        return pasta
+    
+    def _indexar_pasta(self):
+        """Varre a pasta escolhida para o índice da biblioteca (incremental)."""
+        pasta = self._pasta_biblioteca()
+        if pasta:
+            self.motor.indexar(pasta)
+    
+    def _adotar_pasta(self):
+        """Adota as músicas já existentes na pasta escolhida (não baixa de novo)."""
+        pasta = self._pasta_biblioteca()
+        if pasta:
+            self.motor.adotar(pasta)
+    
+    def _procurar_duplicatas(self):
+        """Procura gravações repetidas na pasta escolhida."""
+        if not self.ffmpeg_info:
+            messagebox.showerror("FFmpeg não encontrado", "O FFmpeg é necessário para comparar o áudio!")
+            return
+        pasta = self._pasta_biblioteca()
+        if pasta:
+            self.motor.deduplicar(pasta, self.ffmpeg_info["caminho"])
+    
     def _iniciar_download(self):
         """Inicia processo de download."""
         if self.baixando:
@@ -289,14 +502,22 @@ class BaixaFyInterface:
         self.baixando = True
         self.btn_download.configure(state="disabled", text="⏳ Baixando...")
         self.btn_parar.configure(state="normal")
+        self.btn_pausar.configure(state="normal", text="⏸️ Pausar")
+        self.btn_drenar.configure(state="normal")
+        self.pausado = False
         self._log(f"🎵 Iniciando download: {url}")
         self._log(f"📁 Destino: {pasta}")
         self._atualizar_status("🔄 Download em andamento...")
         
-        # Thread de download
-        thread = threading.Thread(target=self._download_thread, args=(url, pasta))
-        thread.daemon = True
-        thread.start()
+        perfil = self._perfil_selecionado()
+        self._log(f"🎚️ Perfil: {perfil['nome']} ({perfil.get('encoder', 'padrão')})")
+        self.progress_bar.set(0)
+        self.total_musicas = 0
+        self.musicas_feitas = 0
+        
+        # Job no motor de downloads (eventos chegam por _bombear_eventos)
+        ffmpeg = self.ffmpeg_info["caminho"] if self.ffmpeg_info else None
+        self.job_atual = self.motor.enviar(url, pasta, perfil, ffmpeg)
     
     def _validar_url_spotify(self, url: str) -> bool:
         """Valida URL do Spotify."""
@@ -308,59 +529,107 @@ class BaixaFyInterface:
         ]
         return any(url.startswith(pattern) for pattern in patterns)
     
-    def _download_thread(self, url: str, pasta: str):
-        """Thread de download."""
+    def _bombear_eventos(self):
+        """Consome os eventos do motor no loop do Tk (em lote, a cada 100 ms)."""
         try:
-            # Comando SpotDL
-            cmd = [
-                'spotdl',
-                url,
-                '--output', pasta,
-                '--format', 'mp3',
-                '--bitrate', '320k'
-            ]
-            
-            self.root.after(0, self._log, f"💻 Comando: {' '.join(cmd)}")
-            
-            # Executar com output em tempo real
-            self.processo_atual = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                universal_newlines=True,
-                bufsize=1
-            )
-            
-            # Ler output em tempo real
-            for line in iter(self.processo_atual.stdout.readline, ''):
-                if line.strip():
-                    self.root.after(0, self._log, f"🔄 {line.strip()}")
-            
-            # Aguardar conclusão
-            return_code = self.processo_atual.wait()
-            
-            if return_code == 0:
-                self.root.after(0, self._download_sucesso, pasta)
-            else:
-                self.root.after(0, self._download_erro, f"Código de saída: {return_code}")
-                
-        except Exception as e:
-            self.root.after(0, self._download_erro, str(e))
-        finally:
-            self.processo_atual = None
+            while True:
+                self._tratar_evento(self.motor.eventos.get_nowait())
+        except queue.Empty:
+            pass
+        self.root.after(100, self._bombear_eventos)
     
-    def _parar_download(self):
-        """Para download atual."""
-        if self.processo_atual:
-            try:
-                self.processo_atual.terminate()
+    def _tratar_evento(self, evento: dict):
+        """Atualiza a interface a partir de um evento estruturado do motor."""
+        if evento["tipo"] == "biblioteca":
+            self._log(evento["texto"])
+            if evento.get("fim"):
+                for botao in self.botoes_biblioteca:
+                    botao.configure(state="normal")
+            return
+        if evento["job"] != self.job_atual:
+            return
+        
+        tipo = evento["tipo"]
+        if tipo == "log":
+            self._log(f"🔄 {evento['texto']}")
+        elif tipo == "aviso":
+            self._log(f"⚠️ {evento['texto']}")
+            self._atualizar_status(f"⚠️ {evento['texto']}")
+        elif tipo == "expandido":
+            # Chega uma vez por página da playlist; o total vai sendo refinado
+            if evento["total"] != self.total_musicas:
+                self.total_musicas = evento["total"]
+                self._log(f"📋 {evento['total']} música(s) na fila")
+        elif tipo == "progresso":
+            self._atualizar_status(
+                f"🔄 {evento.get('nome', '')}: {evento['mensagem']} ({evento['progresso']:.0f}%)")
+        elif tipo == "musica_fim":
+            self.musicas_feitas += 1
+            self.progress_bar.set(self.musicas_feitas / max(self.total_musicas, 1))
+            if evento["codigo"] == 0:
+                self._log(f"✅ [{self.musicas_feitas}/{self.total_musicas}] {evento['nome']}")
+            else:
+                self._log(f"❌ [{self.musicas_feitas}/{self.total_musicas}] {evento['nome']}: {evento['erro']}")
+        elif tipo == "job_fim":
+            if evento["codigo"] == 0:
+                self.progress_bar.set(1)
+                self._download_sucesso(evento["pasta"])
+            elif evento["codigo"] > 0:
+                self._download_erro(evento["erro"])
+            elif evento["codigo"] == FIM_INTERROMPIDO:
+                self._log(f"⏭️ Download interrompido: {evento['erro']}")
+                self._log("♻️ Baixe o mesmo link de novo para continuar de onde parou")
+                self._atualizar_status("⏭️ Download interrompido")
+                self._finalizar_download()
+            else:
                 self._log("⏹️ Download cancelado pelo usuário")
                 self._atualizar_status("⏹️ Download cancelado")
-            except:
-                pass
+                self._finalizar_download()
+    
+    def _parar_download(self):
+        """Para download atual.
         
-        self._finalizar_download()
+        A interface só é liberada quando o motor confirma o fim do job,
+        depois de matar a árvore de processos e limpar arquivos parciais.
+        """
+        if not self.job_atual:
+            self._finalizar_download()
+            return
+        
+        self.motor.cancelar(self.job_atual)
+        self.btn_parar.configure(state="disabled")
+        self.btn_pausar.configure(state="disabled")
+        self.btn_drenar.configure(state="disabled")
+        self._log("⏹️ Cancelando download...")
+        self._atualizar_status("⏳ Cancelando download...")
+    
+    def _pausar_download(self):
+        """Pausa ou retoma o despacho de músicas do job atual."""
+        if not self.job_atual:
+            return
+        
+        self.pausado = not self.pausado
+        if self.pausado:
+            self.motor.pausar(self.job_atual)
+            self.btn_pausar.configure(text="▶️ Retomar")
+            self._log("⏸️ Pausado: as músicas em andamento serão concluídas")
+            self._atualizar_status("⏸️ Download pausado")
+        else:
+            self.motor.retomar(self.job_atual)
+            self.btn_pausar.configure(text="⏸️ Pausar")
+            self._log("▶️ Download retomado")
+            self._atualizar_status("🔄 Download em andamento...")
+    
+    def _drenar_download(self):
+        """Conclui as músicas em andamento e para (o resto fica no checkpoint)."""
+        if not self.job_atual:
+            return
+        
+        self.motor.drenar(self.job_atual)
+        self.btn_pausar.configure(state="disabled")
+        self.btn_drenar.configure(state="disabled")
+        self._log("⏭️ Finalizando as músicas em andamento antes de parar...")
+        self._atualizar_status("⏳ Finalizando músicas em andamento...")
     
     def _download_sucesso(self, pasta: str):
         """Download concluído com sucesso."""
@@ -381,6 +650,9 @@ class BaixaFyInterface:
         self._log(f"❌ Erro no download: {erro}")
         self._atualizar_status("❌ Erro no download")
         
+        # Revalida o spotdl: o cache pode estar mascarando uma instalação quebrada
+        self._verificar_spotdl(forcar=True)
+        
         messagebox.showerror(
             "Erro no Download",
             f"❌ Erro ao baixar música:\n\n{erro}\n\n"
@@ -397,6 +669,8 @@ class BaixaFyInterface:
         self.baixando = False
         self.btn_download.configure(state="normal", text="⬇️ Baixar")
         self.btn_parar.configure(state="disabled")
+        self.btn_pausar.configure(state="disabled", text="⏸️ Pausar")
+        self.btn_drenar.configure(state="disabled")
     
     def _log(self, mensagem: str):
         """Adiciona mensagem ao log."""
@@ -428,7 +702,9 @@ class BaixaFyInterface:
         self._log("🔍 Verificando SpotDL...")
         
         # Executar
+        self._bombear_eventos()
         self.root.mainloop()
+        self.motor.encerrar()
 
 def main():
     """Função principal."""
@@ -0,0 +1,3394 @@
+#!/usr/bin/env python3
+"""
+BaixaFy Motor - downloads, workers spotDL, biblioteca e verificações.
+Não depende da interface: é importado por baixafy_interface.py e executado
+diretamente como processo worker (`baixafy_motor.py --worker`).
+"""
+
+import threading
+import asyncio
+import queue
+import os
+import sys
+import subprocess
+import signal
+import shutil
+import json
+import hashlib
+import importlib
+import sqlite3
+import shlex
+import errno
+import mmap
+import re
+import unicodedata
+import array
+import base64
+import collections
+import math
+import random
+import urllib.request
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+import time
+
+# Caminhos da versão portátil
+PASTA_APP = Path(__file__).resolve().parent
+PASTA_FFMPEG = PASTA_APP / "ffmpeg-7.1.1"
+
+# Perfis de saída: encoders em ordem de preferência (mais rápido primeiro).
+# O último encoder de cada lista é o que o spotdl já usa por padrão.
+PERFIS = [
+    {"nome": "MP3 320k", "formato": "mp3", "bitrate": "320k",
+     "encoders": ["libmp3lame"], "muxer": "mp3"},
+    {"nome": "M4A 256k", "formato": "m4a", "bitrate": "256k",
+     "encoders": ["aac_at", "libfdk_aac", "aac"], "muxer": "ipod"},
+    {"nome": "Opus 160k", "formato": "opus", "bitrate": "160k",
+     "encoders": ["libopus"], "muxer": "ogg"},
+    # Sem o silêncio do começo e do fim da fonte (ver `detectar_silencio`)
+    {"nome": "MP3 320k sem silêncio", "formato": "mp3", "bitrate": "320k",
+     "encoders": ["libmp3lame"], "muxer": "mp3", "aparar_silencio": True},
+]
+
+
+@lru_cache(maxsize=None)
+def _pasta_dados() -> Path:
+    """Obtém pasta gravável para caches e configurações do BaixaFy."""
+    for pasta in (PASTA_APP / "dados", Path.home() / ".baixafy"):
+        try:
+            pasta.mkdir(parents=True, exist_ok=True)
+            if os.access(pasta, os.W_OK):
+                return pasta
+        except OSError:
+            continue
+    return Path.home()
+
+
+def chave_arquivo(caminho: str) -> str:
+    """Chave de cache baseada em caminho, tamanho e mtime do arquivo."""
+    info = os.stat(caminho)
+    return f"{os.path.abspath(caminho)}|{info.st_size}|{info.st_mtime_ns}"
+
+
+def ler_cache(nome: str) -> dict:
+    """Lê um cache JSON da pasta de dados (vazio se não existir)."""
+    try:
+        with open(_pasta_dados() / nome, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _gravar_json(destino: Path, dados: dict):
+    """Grava um JSON de forma atômica (arquivo temporário + rename)."""
+    temp = destino.with_name(destino.name + ".tmp")
+    try:
+        with open(temp, "w", encoding="utf-8") as f:
+            json.dump(dados, f, ensure_ascii=False, indent=1)
+        os.replace(temp, destino)
+    except OSError:
+        pass
+
+
+def gravar_cache(nome: str, dados: dict):
+    """Grava um cache JSON da pasta de dados."""
+    _gravar_json(_pasta_dados() / nome, dados)
+
+
+def localizar_ffmpeg():
+    """Resolve o ffmpeg usado nos downloads (portátil > spotdl > PATH)."""
+    nome = "ffmpeg.exe" if os.name == "nt" else "ffmpeg"
+    candidatos = [
+        PASTA_FFMPEG / "bin" / nome,
+        PASTA_FFMPEG / nome,
+        Path.home() / ".spotdl" / nome,
+    ]
+    for candidato in candidatos:
+        if candidato.is_file():
+            return str(candidato)
+    return shutil.which("ffmpeg")
+
+
+def localizar_spotdl():
+    """Resolve o executável do spotdl (Scripts portátil > PATH)."""
+    nome = "spotdl.exe" if os.name == "nt" else "spotdl"
+    candidato = PASTA_APP / "python" / "Scripts" / nome
+    if candidato.is_file():
+        return str(candidato)
+    return shutil.which("spotdl")
+
+
+def _listar_recursos_ffmpeg(ffmpeg: str, opcao: str, tipo: str = "") -> list:
+    """Lista nomes da tabela de `ffmpeg -encoders`/`-muxers`."""
+    result = subprocess.run([ffmpeg, "-hide_banner", opcao],
+                            capture_output=True, text=True, timeout=15)
+    nomes = []
+    dentro_tabela = False
+    for linha in result.stdout.splitlines():
+        if linha.strip().startswith("--"):
+            dentro_tabela = True
+            continue
+        partes = linha.split()
+        if not dentro_tabela or len(partes) < 2:
+            continue
+        if tipo and not partes[0].startswith(tipo):
+            continue
+        nomes.extend(partes[1].split(","))
+    return nomes
+
+
+def sondar_ffmpeg(ffmpeg: str) -> dict:
+    """Lê versão, encoders de áudio e muxers do ffmpeg (com cache em disco).
+
+    O cache é indexado por caminho, tamanho e mtime do binário, então só
+    é refeito quando o ffmpeg é trocado.
+    """
+    chave = chave_arquivo(ffmpeg)
+    cache = ler_cache("ffmpeg_cache.json")
+    if cache.get("chave") == chave:
+        return cache
+
+    result = subprocess.run([ffmpeg, "-hide_banner", "-version"],
+                            capture_output=True, text=True, timeout=15)
+    primeira_linha = (result.stdout.splitlines() or [""])[0]
+    versao = primeira_linha.split(" Copyright")[0].replace("ffmpeg version", "").strip()
+
+    info = {
+        "chave": chave,
+        "caminho": ffmpeg,
+        "versao": versao,
+        "encoders": _listar_recursos_ffmpeg(ffmpeg, "-encoders", "A"),
+        "muxers": _listar_recursos_ffmpeg(ffmpeg, "-muxers"),
+    }
+    gravar_cache("ffmpeg_cache.json", info)
+    return info
+
+
+def encoder_disponivel(info: dict, perfil: dict):
+    """Encoder mais rápido do perfil que o ffmpeg sondado suporta."""
+    if perfil["muxer"] not in info.get("muxers", []):
+        return None
+    for encoder in perfil["encoders"]:
+        if encoder in info.get("encoders", []):
+            return encoder
+    return None
+
+
+def escolher_perfil(info: dict, nome: str = None):
+    """Escolhe perfil disponível, com o encoder mais rápido suportado.
+
+    Se o perfil pedido não puder ser gerado por este ffmpeg, usa o
+    primeiro perfil da lista que puder.
+    """
+    ordem = sorted(PERFIS, key=lambda p: p["nome"] != nome)
+    for perfil in ordem:
+        encoder = encoder_disponivel(info, perfil)
+        if encoder:
+            return dict(perfil, encoder=encoder)
+    return None
+
+
+def ffmpeg_args_perfil(perfil: dict):
+    """Argumentos extras do ffmpeg quando o encoder não é o padrão do spotdl."""
+    encoder = perfil.get("encoder")
+    if encoder and encoder != perfil["encoders"][-1]:
+        return f"-c:a {encoder}"
+    return None
+
+
+def argumentos_perfil(perfil: dict, ffmpeg: str = None) -> list:
+    """Converte um perfil em argumentos de linha de comando do spotdl."""
+    args = ['--format', perfil["formato"], '--bitrate', perfil["bitrate"]]
+    if ffmpeg:
+        args += ['--ffmpeg', ffmpeg]
+    ffmpeg_args = ffmpeg_args_perfil(perfil)
+    if ffmpeg_args:
+        args += ['--ffmpeg-args', ffmpeg_args]
+    return args
+
+# Configurações avançadas (editáveis em dados/config.json)
+CONFIG_PADRAO = {
+    "workers": 1,
+    "jobs_por_worker": 25,
+    "memoria_max_worker_mb": 700,
+    "espera_cancelamento_s": 5,
+    "segmentos_por_download": 4,
+    "segmento_min_mb": 8,
+    "workers_prefetch": 1,
+    "prefetch": 4,
+    "margem_disco_mb": 500,
+    "espaco_insuficiente": "dividir",
+    # Pasta rápida (tmpfs, RAM disk, SSD) para fontes e conversões; vazio
+    # usa o próprio volume de destino
+    "pasta_rascunho": "",
+    # Envio (write-behind) do rascunho para o destino
+    "envios_simultaneos": 2,
+    "tentativas_envio": 3,
+    # Nome de ORGANIZACOES ou um template do spotdl relativo à pasta
+    "organizacao": "plana",
+    "threads_varredura": 8,
+    # Processos para ler tags e hashes na adoção de biblioteca (0 = CPUs)
+    "processos_biblioteca": 0,
+    # Verificação das músicas prontas: processos (0 desliga), fração que
+    # passa por decodificação completa e quantas vezes rebaixar uma corrompida
+    "verificacoes_simultaneas": 2,
+    "verificar_amostra": 0.1,
+    "tentativas_verificacao": 1,
+    # Capas embutidas: lado máximo em pixels (0 mantém o original) e
+    # teto do cache de capas em disco
+    "tamanho_capa": 0,
+    "cache_capas_mb": 64,
+    # ReplayGain: mede a loudness (EBU R128) das músicas prontas e grava as
+    # tags de ganho da faixa (e do álbum, em jobs de álbum)
+    "replaygain": False,
+    "processos_loudness": 1,
+}
+
+# Layouts de saída. Em "prefixo" cada arquivo vai para uma subpasta com os
+# dois primeiros dígitos hex do sha1 do id da música (256 pastas).
+ORGANIZACOES = {
+    "plana": "{artists} - {title}.{output-ext}",
+    "artista_album": "{album-artist}/{album}/{artists} - {title}.{output-ext}",
+    "prefixo": "{artists} - {title}.{output-ext}",
+}
+
+# Estimativa de tamanho quando a duração ainda não é conhecida
+DURACAO_PADRAO_S = 240
+SOBRECARGA_ARQUIVO = 200 * 1024
+
+# Saídas em construção ficam aqui (no volume de destino ou na pasta de
+# rascunho) até estarem completas; na pasta final só aparece arquivo pronto.
+PASTA_TEMPORARIA = ".baixafy-tmp"
+
+# Cópias para o destino em blocos grandes e sequenciais
+BLOCO_COPIA = 8 << 20
+# Conexões mantidas abertas por host na sessão HTTP de cada worker
+CONEXOES_POR_HOST = 16
+
+# Folga deixada ao gravar tags: edições seguintes (ReplayGain, correções)
+# cabem no lugar sem deslocar o áudio. Capas mantidas em memória por worker.
+FOLGA_TAGS = 16 * 1024
+CAPAS_POR_WORKER = 8
+
+# Referência do ReplayGain 2.0 (LUFS); Opus usa R128_* relativas a -23 LUFS
+REFERENCIA_REPLAYGAIN = -18.0
+REFERENCIA_R128 = -23.0
+
+# Aparar silêncio: abaixo de SILENCIO_DB por pelo menos SILENCIO_MIN_S nas
+# pontas da fonte; MARGEM_SILENCIO_S fica para não cortar o ataque/fade.
+# Atraso do encoder AAC (amostras de priming) para o iTunSMPB.
+SILENCIO_DB = -50
+SILENCIO_MIN_S = 1.0
+MARGEM_SILENCIO_S = 0.2
+ATRASO_AAC = {"aac": 1024, "aac_at": 2112, "libfdk_aac": 2048}
+
+# Extensões consideradas pela varredura da biblioteca
+EXTENSOES_AUDIO = {".mp3", ".m4a", ".opus", ".ogg", ".flac", ".wav"}
+
+# Impressão digital acústica (no estilo Haitsma–Kalker): energia em bandas
+# log-espaçadas de 300 a 2000 Hz, QUADROS_POR_S quadros por segundo, uma
+# palavra de 16 bits por quadro. Gravações iguais ficam abaixo de
+# LIMIAR_IMPRESSAO bits diferentes; gravações distintas ficam perto de 0,5.
+BANDAS_IMPRESSAO = 17
+QUADROS_POR_S = 32
+DURACAO_IMPRESSAO_S = 300
+LIMIAR_IMPRESSAO = 0.3
+# Índice de impressões: 1 chave de 32 bits a cada AMOSTRA_CHAVES quadros;
+# VOTOS_IMPRESSAO chaves no mesmo deslocamento tornam outra gravação candidata
+AMOSTRA_CHAVES = 8
+VOTOS_IMPRESSAO = 2
+
+# Códigos de fim de job além do código de saída do spotdl
+FIM_CANCELADO = -1
+FIM_INTERROMPIDO = -2
+
+
+def carregar_config() -> dict:
+    """Carrega config.json mesclado aos padrões (cria o arquivo se faltar)."""
+    caminho = _pasta_dados() / "config.json"
+    config = dict(CONFIG_PADRAO)
+    try:
+        with open(caminho, encoding="utf-8") as f:
+            config.update(json.load(f))
+    except (OSError, ValueError):
+        gravar_cache("config.json", config)
+    return config
+
+
+def _memoria_processo_mb() -> float:
+    """Memória residente do processo atual, em MB (0 se indisponível)."""
+    try:
+        if os.name == "nt":
+            import ctypes
+            from ctypes import wintypes
+
+            class ContadoresMemoria(ctypes.Structure):
+                _fields_ = [
+                    ("cb", wintypes.DWORD),
+                    ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t),
+                    ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t),
+                    ("PeakPagefileUsage", ctypes.c_size_t),
+                ]
+
+            kernel32 = ctypes.WinDLL("kernel32")
+            kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+            kernel32.K32GetProcessMemoryInfo.argtypes = [
+                wintypes.HANDLE, ctypes.POINTER(ContadoresMemoria), wintypes.DWORD]
+            contadores = ContadoresMemoria()
+            contadores.cb = ctypes.sizeof(contadores)
+            kernel32.K32GetProcessMemoryInfo(
+                kernel32.GetCurrentProcess(), ctypes.byref(contadores), contadores.cb)
+            return contadores.WorkingSetSize / 2**20
+
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except Exception:
+        return 0.0
+
+
+def _opcoes_grupo_processo() -> dict:
+    """Opções de Popen para o filho ganhar um grupo de processos próprio."""
+    if os.name == "nt":
+        return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {"start_new_session": True}
+
+
+async def encerrar_arvore_processos(processo, espera: float = 5.0):
+    """Encerra um processo e toda a árvore dele (ffmpeg, yt-dlp...).
+
+    Primeiro pede o encerramento, espera até `espera` segundos e então
+    mata à força o que sobrou. O processo precisa ter sido criado com
+    `_opcoes_grupo_processo` para os netos serem alcançados no POSIX.
+    """
+    if os.name == "nt":
+        # Sem /F o taskkill só pede o fechamento; /T inclui os filhos
+        taskkill = ["taskkill", "/PID", str(processo.pid), "/T"]
+        try:
+            await (await asyncio.create_subprocess_exec(
+                *taskkill, stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL)).wait()
+        except OSError:
+            pass
+    else:
+        try:
+            os.killpg(processo.pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    try:
+        await asyncio.wait_for(processo.wait(), timeout=espera)
+    except asyncio.TimeoutError:
+        pass
+
+    # Filhos que ignoraram o pedido (ou o próprio processo) morrem à força
+    if os.name == "nt":
+        if processo.returncode is None:
+            try:
+                await (await asyncio.create_subprocess_exec(
+                    *taskkill[:-1], "/T", "/F", stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.DEVNULL)).wait()
+            except OSError:
+                processo.kill()
+    else:
+        try:
+            os.killpg(processo.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+    await processo.wait()
+
+
+def _ler_json(caminho: Path) -> dict:
+    """Lê um JSON qualquer (vazio se não existir ou estiver corrompido)."""
+    try:
+        with open(caminho, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def nova_sessao_http():
+    """Sessão HTTP de um worker: conexões reaproveitadas entre músicas e tentativas.
+
+    Fontes, retomadas e faixas paralelas vão quase sempre ao mesmo host; o
+    pool guarda até `CONEXOES_POR_HOST` conexões abertas por host.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    sessao = requests.Session()
+    for esquema in ("http://", "https://"):
+        sessao.mount(esquema, HTTPAdapter(pool_maxsize=CONEXOES_POR_HOST))
+    return sessao
+
+
+def _sessao_http(contexto: dict):
+    """Sessão HTTP do worker (criada no primeiro uso)."""
+    if "sessao" not in contexto:
+        contexto["sessao"] = nova_sessao_http()
+    return contexto["sessao"]
+
+
+def _pedir(sessao, url: str, cabecalhos: dict, timeout: float):
+    """GET em streaming; erros HTTP (4xx/5xx) viram `requests.HTTPError`."""
+    resposta = sessao.get(url, headers=cabecalhos, stream=True, timeout=timeout)
+    if resposta.status_code >= 400:
+        resposta.close()
+        resposta.raise_for_status()
+    # Queda no meio do corpo entrega o que chegou em vez de descartar o
+    # último bloco; quem lê confere o tamanho e retoma a partir dali
+    resposta.raw.enforce_content_length = False
+    return resposta
+
+
+def _validador_if_range(meta: dict):
+    """ETag forte ou, na falta dela, Last-Modified, para o `If-Range`.
+
+    ETag fraca (`W/"..."`) nunca confere em If-Range (RFC 7233): com ela o
+    servidor responderia 200 com o arquivo inteiro a cada retomada.
+    """
+    etag = meta.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return meta.get("last_modified")
+
+
+def _abrir_retomando(sessao, url: str, parcial: Path, meta_arq: Path, cabecalhos: dict,
+                     timeout: float) -> tuple:
+    """Abre a conexão pedindo só o que falta do parcial (se ele for válido).
+
+    Retorna (resposta, posição inicial, tamanho total ou None).
+    """
+    meta = _ler_json(meta_arq)
+    if "segmentos" in meta:
+        # Parcial segmentado é pré-alocado: o tamanho dele não é o que já
+        # foi baixado e não serve de ponto de retomada
+        parcial.unlink(missing_ok=True)
+        meta_arq.unlink(missing_ok=True)
+        meta = {}
+    inicio = parcial.stat().st_size if parcial.exists() and meta else 0
+    pedido = dict(cabecalhos)
+    if inicio:
+        pedido["Range"] = f"bytes={inicio}-"
+        validador = _validador_if_range(meta)
+        if validador:
+            pedido["If-Range"] = validador
+
+    resposta = _pedir(sessao, url, pedido, timeout)
+    if resposta.status_code == 206:
+        # Content-Range: bytes <início>-<fim>/<total>
+        faixa = resposta.headers.get("Content-Range", "")
+        try:
+            inicio_faixa = int(faixa.split()[1].split("-")[0])
+            total = int(faixa.rsplit("/", 1)[1])
+        except (IndexError, ValueError):
+            inicio_faixa, total = -1, None
+        if inicio_faixa == inicio and total == meta.get("tamanho"):
+            return resposta, inicio, total
+        # Faixa inesperada ou fonte de outro tamanho: recomeça do zero
+        resposta.close()
+        parcial.unlink()
+        meta_arq.unlink()
+        return _abrir_retomando(sessao, url, parcial, meta_arq, cabecalhos, timeout)
+
+    # 200: sem parcial, Range ignorado ou validador não confere
+    tamanho = resposta.headers.get("Content-Length")
+    total = int(tamanho) if tamanho and tamanho.isdigit() else None
+    _gravar_json(meta_arq, {
+        "etag": resposta.headers.get("ETag"),
+        "last_modified": resposta.headers.get("Last-Modified"),
+        "tamanho": total,
+    })
+    return resposta, 0, total
+
+
+def _prealocar(arquivo: Path, tamanho: int):
+    """Cria `arquivo` já com `tamanho` bytes reservados no disco."""
+    with open(arquivo, "wb") as f:
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(f.fileno(), 0, tamanho)
+                return
+            except OSError:
+                pass
+        f.truncate(tamanho)
+
+
+def mover_atomico(origem: Path, destino: Path) -> Path:
+    """Publica `origem` em `destino` sem nunca expor um arquivo pela metade.
+
+    No mesmo volume é só um `os.replace`. Entre volumes (pasta de rascunho),
+    copia em blocos de `BLOCO_COPIA` para um temporário ao lado do destino,
+    pré-alocado com o tamanho final (já conhecido), e renomeia no fim.
+    """
+    destino.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.replace(origem, destino)
+        return destino
+    except OSError as e:
+        # EXDEV no POSIX, ERROR_NOT_SAME_DEVICE (17) no Windows
+        if e.errno != errno.EXDEV and getattr(e, "winerror", None) != 17:
+            raise
+
+    temporario = destino.with_name(f".{destino.name}.parcial")
+    try:
+        _prealocar(temporario, origem.stat().st_size)
+        with open(origem, "rb") as entrada, open(temporario, "r+b") as saida:
+            shutil.copyfileobj(entrada, saida, BLOCO_COPIA)
+            saida.flush()
+            os.fsync(saida.fileno())
+        os.replace(temporario, destino)
+    except BaseException:
+        temporario.unlink(missing_ok=True)
+        raise
+    origem.unlink()
+    return destino
+
+
+def _arquivo_temporario(pasta: str, musica, formato: str) -> Path:
+    """Caminho de montagem de uma música antes de ir para o destino."""
+    return Path(pasta) / PASTA_TEMPORARIA / f"{musica.song_id}.{formato}"
+
+
+def _limpar_temporarios(pasta: str, idade_s: float = 24 * 3600):
+    """Apaga sobras de montagens antigas (processos mortos no meio)."""
+    limite = time.time() - idade_s
+    try:
+        entradas = list(os.scandir(Path(pasta) / PASTA_TEMPORARIA))
+    except OSError:
+        return
+    for entrada in entradas:
+        try:
+            if entrada.is_file() and entrada.stat().st_mtime < limite:
+                os.remove(entrada.path)
+        except OSError:
+            pass
+
+
+class FonteAlterada(Exception):
+    """O servidor deixou de honrar Range/If-Range no meio do download."""
+
+
+def _baixar_segmentado(sessao, url: str, parcial: Path, meta_arq: Path, cabecalhos: dict,
+                       ao_progresso, segmentos: int, segmento_min: int,
+                       tentativas: int, timeout: float, recomecar: bool = True) -> bool:
+    """Baixa a fonte em faixas de bytes paralelas, direto nos offsets finais.
+
+    Retorna False quando não se aplica (servidor sem Range, tamanho
+    desconhecido, arquivo pequeno ou parcial de download simples), para o
+    chamador seguir pelo download em uma conexão só. O mesmo vale para um
+    servidor que ignora Range nas faixas: recomeça do zero uma vez só.
+    """
+    import requests
+
+    meta = _ler_json(meta_arq)
+    if parcial.exists() and meta and "segmentos" not in meta:
+        return False
+
+    if not (parcial.exists() and meta):
+        # Sonda: 1 byte diz se há Range e qual o tamanho total
+        with _pedir(sessao, url, dict(cabecalhos, Range="bytes=0-0"), timeout) as resposta:
+            faixa = resposta.headers.get("Content-Range", "")
+            if resposta.status_code != 206 or "/" not in faixa or faixa.endswith("*"):
+                return False
+            # Lê o byte para a conexão voltar ao pool da sessão
+            resposta.content
+            total = int(faixa.rsplit("/", 1)[1])
+            etag = resposta.headers.get("ETag")
+            last_modified = resposta.headers.get("Last-Modified")
+        partes = min(segmentos, total // segmento_min)
+        if partes < 2:
+            return False
+        passo = -(-total // partes)
+        meta = {
+            "etag": etag,
+            "last_modified": last_modified,
+            "tamanho": total,
+            "segmentos": [[ini, min(ini + passo, total) - 1, 0] for ini in range(0, total, passo)],
+        }
+        _prealocar(parcial, total)
+        _gravar_json(meta_arq, meta)
+
+    total = meta["tamanho"]
+    validador = _validador_if_range(meta)
+    trava = threading.Lock()
+    parar = threading.Event()
+
+    def salvar_progresso():
+        with trava:
+            _gravar_json(meta_arq, meta)
+
+    def baixar_faixa(segmento: list):
+        desde_salvo = 0
+        for tentativa in range(1, tentativas + 1):
+            inicio, fim, feito = segmento
+            if inicio + feito > fim or parar.is_set():
+                return
+            pedido = dict(cabecalhos, Range=f"bytes={inicio + feito}-{fim}")
+            if validador:
+                pedido["If-Range"] = validador
+            try:
+                with _pedir(sessao, url, pedido, timeout) as resposta, \
+                        open(parcial, "r+b") as f:
+                    if resposta.status_code != 206:
+                        raise FonteAlterada("Servidor ignorou Range na retomada")
+                    f.seek(inicio + feito)
+                    restante = fim + 1 - (inicio + feito)
+                    for bloco in resposta.iter_content(1 << 16):
+                        if parar.is_set():
+                            return
+                        # Nunca escreve além da faixa, mesmo que venha mais
+                        lidos = min(len(bloco), restante)
+                        f.write(memoryview(bloco)[:lidos])
+                        restante -= lidos
+                        with trava:
+                            segmento[2] += lidos
+                            baixados = sum(s[2] for s in meta["segmentos"])
+                        desde_salvo += lidos
+                        if desde_salvo >= 4 << 20:
+                            desde_salvo = 0
+                            salvar_progresso()
+                        if ao_progresso:
+                            ao_progresso(baixados, total)
+                        if not restante:
+                            break
+                if segmento[0] + segmento[2] <= segmento[1]:
+                    raise ConnectionError("Conexão encerrada antes do fim da faixa")
+                return
+            except (requests.RequestException, ConnectionError, TimeoutError):
+                salvar_progresso()
+                if tentativa == tentativas:
+                    raise
+                time.sleep(tentativa)
+
+    with ThreadPoolExecutor(max_workers=len(meta["segmentos"])) as executor:
+        futuros = [executor.submit(baixar_faixa, s) for s in meta["segmentos"]]
+        # A primeira faixa que falhar interrompe as outras: o resultado já
+        # está perdido e o progresso de cada uma fica salvo para a retomada
+        concurrent.futures.wait(futuros, return_when=concurrent.futures.FIRST_EXCEPTION)
+        parar.set()
+    erros = [futuro.exception() for futuro in futuros if futuro.exception()]
+    if any(isinstance(erro, FonteAlterada) for erro in erros):
+        # Fonte mudou (ou Range deixou de valer): descarta tudo e recomeça,
+        # por faixas uma vez e depois pela conexão única
+        parcial.unlink(missing_ok=True)
+        meta_arq.unlink(missing_ok=True)
+        if not recomecar:
+            return False
+        return _baixar_segmentado(sessao, url, parcial, meta_arq, cabecalhos, ao_progresso,
+                                  segmentos, segmento_min, tentativas, timeout, recomecar=False)
+    salvar_progresso()
+    if erros:
+        raise erros[0]
+    return True
+
+
+def baixar_retomavel(url: str, destino, cabecalhos: dict = None, ao_progresso=None,
+                     tentativas: int = 3, timeout: float = 30, segmentos: int = 1,
+                     segmento_min: int = 8 << 20, sessao=None) -> Path:
+    """Baixa `url` em `destino`, retomando parciais com HTTP Range.
+
+    Enquanto incompleto, o conteúdo fica em `<destino>.parcial` e os
+    metadados de validação (ETag/Last-Modified e tamanho total) em
+    `<destino>.parcial.json`. Uma nova tentativa, nesta chamada ou numa
+    execução futura, pede só os bytes que faltam com `Range` + `If-Range`;
+    se o servidor não aceitar Range ou a fonte tiver mudado, recomeça do
+    zero. `ao_progresso(baixados, total)` é chamado a cada bloco.
+
+    Com `segmentos` > 1, fontes grandes (ao menos dois pedaços de
+    `segmento_min` bytes) são baixadas em faixas paralelas; o progresso de
+    cada faixa também fica no `.parcial.json` para retomada. Um parcial
+    segmentado é sempre retomado por faixas, qualquer que seja `segmentos`.
+
+    Todos os pedidos (sonda, faixas, retomadas) passam por `sessao`
+    (`nova_sessao_http()`), reaproveitando conexões; sem ela, uma sessão
+    vale só para esta chamada.
+    """
+    import requests
+
+    destino = Path(destino)
+    if destino.exists():
+        return destino
+    parcial = destino.with_name(destino.name + ".parcial")
+    meta_arq = destino.with_name(destino.name + ".parcial.json")
+    sessao = sessao or nova_sessao_http()
+    # Range conta bytes do corpo como está no servidor, sem compressão
+    cabecalhos = dict(cabecalhos or {}, **{"Accept-Encoding": "identity"})
+
+    # Parcial de um download segmentado continua segmentado, mesmo que a
+    # configuração tenha mudado para uma conexão só
+    segmentado = parcial.exists() and "segmentos" in _ler_json(meta_arq)
+    if (segmentos > 1 or segmentado) and _baixar_segmentado(
+            sessao, url, parcial, meta_arq, cabecalhos, ao_progresso,
+            segmentos, segmento_min, tentativas, timeout):
+        os.replace(parcial, destino)
+        meta_arq.unlink(missing_ok=True)
+        return destino
+
+    for tentativa in range(1, tentativas + 1):
+        try:
+            try:
+                resposta, baixados, total = _abrir_retomando(
+                    sessao, url, parcial, meta_arq, cabecalhos, timeout)
+            except requests.HTTPError as e:
+                # 416: o parcial já tinha todos os bytes
+                meta = _ler_json(meta_arq)
+                if (e.response.status_code != 416 or not parcial.exists()
+                        or parcial.stat().st_size != meta.get("tamanho")):
+                    raise
+                break
+
+            with resposta, open(parcial, "ab" if baixados else "wb") as f:
+                for bloco in resposta.iter_content(1 << 16):
+                    f.write(bloco)
+                    baixados += len(bloco)
+                    if ao_progresso and total:
+                        ao_progresso(baixados, total)
+            if total is not None and baixados != total:
+                raise ConnectionError(f"Conexão encerrada em {baixados} de {total} bytes")
+            break
+        except (requests.RequestException, ConnectionError, TimeoutError) as e:
+            if isinstance(e, requests.HTTPError) and e.response.status_code < 500:
+                raise
+            if tentativa == tentativas:
+                raise
+            time.sleep(tentativa)
+
+    os.replace(parcial, destino)
+    meta_arq.unlink(missing_ok=True)
+    return destino
+
+
+class CacheCapas:
+    """Cache de capas em disco, endereçado pelo conteúdo e compartilhado entre workers.
+
+    `<sha1(url|px)>.ref` aponta para `<sha1(imagem)>.jpg|png`, a capa já
+    reduzida a `px` pixels de lado (0 mantém o original); URLs diferentes
+    com a mesma imagem dividem o arquivo. Cada uso renova o mtime e, acima
+    de `limite` bytes, saem os menos usados. Busca e redução rodam num pool
+    de threads, então a capa fica pronta enquanto o áudio baixa.
+    """
+
+    def __init__(self, pasta: Path, px: int, limite: int, ffmpeg: str):
+        self.pasta = pasta
+        self.px = px
+        self.limite = limite
+        self.ffmpeg = ffmpeg
+        self.pasta.mkdir(parents=True, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=2)
+        # Últimas capas pedidas neste worker (futuros com os bytes)
+        self._pedidos = collections.OrderedDict()
+        self._trava = threading.Lock()
+
+    def preparar(self, url: str) -> concurrent.futures.Future:
+        """Agenda a capa de `url` (uma vez); o futuro dá os bytes ou None."""
+        with self._trava:
+            if url not in self._pedidos:
+                self._pedidos[url] = self._executor.submit(self._carregar, url)
+                while len(self._pedidos) > CAPAS_POR_WORKER:
+                    self._pedidos.popitem(last=False)
+            self._pedidos.move_to_end(url)
+            return self._pedidos[url]
+
+    def _carregar(self, url: str):
+        ref = self.pasta / (hashlib.sha1(f"{url}|{self.px}".encode("utf-8")).hexdigest() + ".ref")
+        try:
+            imagem = self.pasta / ref.read_text(encoding="ascii").strip()
+            dados = imagem.read_bytes()
+            os.utime(ref)
+            os.utime(imagem)
+            return dados
+        except OSError:
+            pass
+        try:
+            with urllib.request.urlopen(url, timeout=30) as resposta:
+                dados = resposta.read()
+        except OSError:
+            # Sem capa esta vez; não insiste nas outras faixas do álbum
+            return None
+        if self.px:
+            dados = self._reduzir(dados) or dados
+        nome = hashlib.sha1(dados).hexdigest() + (".png" if dados.startswith(b"\x89PNG") else ".jpg")
+        self._gravar(self.pasta / nome, dados)
+        self._gravar(ref, nome.encode("ascii"))
+        self._podar()
+        return dados
+
+    def _reduzir(self, dados: bytes):
+        """JPEG com no máximo `px` de lado, via ffmpeg; None se falhar."""
+        try:
+            resultado = subprocess.run(
+                [self.ffmpeg, "-v", "error", "-nostdin", "-i", "pipe:0",
+                 # Os dois lados limitados, proporção mantida, nunca ampliada
+                 "-vf", f"scale=w=min(iw\\,{self.px}):h=min(ih\\,{self.px})"
+                        ":force_original_aspect_ratio=decrease", "-frames:v", "1",
+                 "-q:v", "2", "-c:v", "mjpeg", "-f", "image2pipe", "pipe:1"],
+                input=dados, capture_output=True, timeout=60,
+                creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        return resultado.stdout if resultado.returncode == 0 else None
+
+    def _gravar(self, destino: Path, dados: bytes):
+        # Nome temporário único: outros workers podem gravar a mesma capa
+        temp = destino.with_name(f".{destino.name}.{os.getpid()}.{threading.get_ident()}")
+        try:
+            temp.write_bytes(dados)
+            os.replace(temp, destino)
+        except OSError:
+            temp.unlink(missing_ok=True)
+
+    def _podar(self):
+        """Apaga as capas menos usadas até o cache caber em `limite`."""
+        entradas = []
+        for entrada in os.scandir(self.pasta):
+            try:
+                if not entrada.name.startswith("."):
+                    info = entrada.stat()
+                    entradas.append((info.st_mtime, info.st_size, entrada.path))
+            except OSError:
+                pass
+        total = sum(tamanho for _, tamanho, _ in entradas)
+        for _, tamanho, caminho in sorted(entradas):
+            if total <= self.limite:
+                break
+            try:
+                os.remove(caminho)
+                total -= tamanho
+            except OSError:
+                pass
+
+
+def _cache_capas(contexto: dict, opcoes: dict, ffmpeg: str) -> CacheCapas:
+    """Cache de capas do worker para as opções do job."""
+    chave = ("capas", opcoes.get("capa_px", 0), opcoes.get("capas_mb", 64))
+    if chave not in contexto:
+        contexto[chave] = CacheCapas(_pasta_dados() / "capas", chave[1],
+                                     int(chave[2] * 2**20), ffmpeg)
+    return contexto[chave]
+
+
+def _comentarios_vorbis(musica) -> dict:
+    """Tags da música como comentários Vorbis (FLAC, Ogg, Opus)."""
+    tags = {
+        "title": musica.name,
+        "artist": musica.artists,
+        "album": musica.album_name,
+        "albumartist": musica.album_artist,
+        "date": musica.date or (str(musica.year) if musica.year else None),
+        "genre": musica.genres,
+        "tracknumber": str(musica.track_number) if musica.track_number else None,
+        "tracktotal": str(musica.tracks_count) if musica.tracks_count else None,
+        "discnumber": str(musica.disc_number) if musica.disc_number else None,
+        "disctotal": str(musica.disc_count) if musica.disc_count else None,
+        "isrc": musica.isrc,
+        "copyright": musica.copyright_text,
+        "organization": musica.publisher,
+        "lyrics": musica.lyrics,
+        "comment": musica.url,
+    }
+    return {chave: valor if isinstance(valor, list) else [valor]
+            for chave, valor in tags.items() if valor}
+
+
+def _folga_tags(info) -> int:
+    """Política de padding do mutagen: mantém a folga atual se couber.
+
+    Devolver um valor fixo faria o mutagen redimensionar o arquivo (e
+    mover o áudio) a cada mudança no tamanho das tags. Sem folga, ou com
+    folga exagerada, volta a `FOLGA_TAGS`.
+    """
+    if 0 <= info.padding <= 4 * FOLGA_TAGS:
+        return info.padding
+    return FOLGA_TAGS
+
+
+def _gravar_tags(arquivo: Path, musica, capa: bytes = None):
+    """Grava tags e capa no arquivo convertido, numa única escrita.
+
+    Só o bloco de tags é escrito (ID3, comentários Vorbis, átomos MP4),
+    com `FOLGA_TAGS` de sobra; o áudio não é regravado. Formatos sem
+    suporte aqui seguem pelo `embed_metadata` do spotdl.
+    """
+    from mutagen.flac import Picture
+
+    extensao = arquivo.suffix.lower()
+    mime = "image/png" if capa and capa.startswith(b"\x89PNG") else "image/jpeg"
+
+    if extensao == ".mp3":
+        from mutagen import id3
+        tags = id3.ID3()
+        faixa = f"{musica.track_number}/{musica.tracks_count}" if musica.track_number else None
+        disco = f"{musica.disc_number}/{musica.disc_count}" if musica.disc_number else None
+        for quadro, valor in ((id3.TIT2, musica.name), (id3.TPE1, musica.artists),
+                              (id3.TALB, musica.album_name), (id3.TPE2, musica.album_artist),
+                              (id3.TDRC, musica.date or (str(musica.year) if musica.year else None)),
+                              (id3.TCON, musica.genres), (id3.TRCK, faixa), (id3.TPOS, disco),
+                              (id3.TSRC, musica.isrc), (id3.TCOP, musica.copyright_text),
+                              (id3.TPUB, musica.publisher)):
+            if valor:
+                tags.add(quadro(encoding=3, text=valor))
+        if musica.url:
+            tags.add(id3.WOAS(url=musica.url))
+        if musica.lyrics:
+            tags.add(id3.USLT(encoding=3, lang="eng", desc="", text=musica.lyrics))
+        if capa:
+            tags.add(id3.APIC(encoding=3, mime=mime, type=3, desc="Cover", data=capa))
+        tags.save(arquivo, padding=_folga_tags)
+    elif extensao in (".flac", ".ogg", ".opus"):
+        from mutagen.flac import FLAC
+        from mutagen.oggopus import OggOpus
+        from mutagen.oggvorbis import OggVorbis
+        audio = {".flac": FLAC, ".ogg": OggVorbis, ".opus": OggOpus}[extensao](arquivo)
+        if audio.tags is None:
+            audio.add_tags()
+        audio.tags.update(_comentarios_vorbis(musica))
+        if capa:
+            imagem = Picture()
+            imagem.type, imagem.mime, imagem.desc, imagem.data = 3, mime, "Cover", capa
+            if extensao == ".flac":
+                audio.clear_pictures()
+                audio.add_picture(imagem)
+            else:
+                audio.tags["metadata_block_picture"] = [
+                    base64.b64encode(imagem.write()).decode("ascii")]
+        audio.save(padding=_folga_tags)
+    elif extensao == ".m4a":
+        from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
+        audio = MP4(arquivo)
+        if audio.tags is None:
+            audio.add_tags()
+        for chave, valor in (("\xa9nam", musica.name), ("\xa9ART", musica.artists),
+                             ("\xa9alb", musica.album_name), ("aART", musica.album_artist),
+                             ("\xa9day", musica.date or (str(musica.year) if musica.year else None)),
+                             ("\xa9gen", musica.genres), ("cprt", musica.copyright_text),
+                             ("\xa9lyr", musica.lyrics), ("\xa9cmt", musica.url)):
+            if valor:
+                audio.tags[chave] = valor if isinstance(valor, list) else [valor]
+        if musica.track_number:
+            audio.tags["trkn"] = [(musica.track_number, musica.tracks_count or 0)]
+        if musica.disc_number:
+            audio.tags["disk"] = [(musica.disc_number, musica.disc_count or 0)]
+        if musica.isrc:
+            audio.tags["----:com.apple.iTunes:ISRC"] = [MP4FreeForm(musica.isrc.encode("utf-8"))]
+        if capa:
+            formato = MP4Cover.FORMAT_PNG if mime == "image/png" else MP4Cover.FORMAT_JPEG
+            audio.tags["covr"] = [MP4Cover(capa, imageformat=formato)]
+        audio.save(padding=_folga_tags)
+    else:
+        from spotdl.utils.metadata import embed_metadata
+        embed_metadata(arquivo, musica, skip_album_art=capa is None)
+
+
+def medir_loudness(ffmpeg: str, caminho: str):
+    """Loudness integrada (LUFS) e pico real (dBFS) pelo filtro ebur128.
+
+    Retorna (lufs, pico) ou None se o ffmpeg falhar.
+    """
+    try:
+        resultado = subprocess.run(
+            [ffmpeg, "-nostdin", "-hide_banner", "-nostats", "-i", caminho, "-map", "0:a:0",
+             "-af", "ebur128=peak=true:framelog=quiet", "-f", "null", "-"],
+            capture_output=True, creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+    except OSError:
+        return None
+    saida = resultado.stderr.decode("utf-8", "replace")
+    lufs = re.findall(r"^\s*I:\s*(-?[\d.]+|-inf) LUFS", saida, re.M)
+    pico = re.findall(r"^\s*Peak:\s*(-?[\d.]+|-inf) dBFS", saida, re.M)
+    if resultado.returncode != 0 or not lufs or not pico:
+        return None
+    return float(lufs[-1]), float(pico[-1])
+
+
+def gravar_ganhos(caminho: str, lufs: float, pico: float, album: tuple = None):
+    """Grava as tags ReplayGain (e R128 no Opus) de uma música já marcada.
+
+    `album` é (lufs, pico) do álbum ou None. Em arquivos marcados por
+    `_gravar_tags` as tags cabem na folga existente (`_folga_tags` a
+    preserva) e o áudio não se move; arquivos sem folga (fallback de
+    linha de comando) ganham `FOLGA_TAGS` nesta primeira gravação.
+    """
+    medidas = {"track": (lufs, pico)}
+    if album:
+        medidas["album"] = album
+    valores = {}
+    for nome, (loudness, pico_db) in medidas.items():
+        valores[f"replaygain_{nome}_gain"] = f"{REFERENCIA_REPLAYGAIN - loudness:+.2f} dB"
+        valores[f"replaygain_{nome}_peak"] = f"{10 ** (pico_db / 20):.6f}"
+
+    extensao = os.path.splitext(caminho)[1].lower()
+    if extensao == ".mp3":
+        from mutagen import id3
+        try:
+            tags = id3.ID3(caminho)
+        except id3.ID3NoHeaderError:
+            tags = id3.ID3()
+        for chave, valor in valores.items():
+            tags.add(id3.TXXX(encoding=3, desc=chave.upper(), text=valor))
+        tags.save(caminho, padding=_folga_tags)
+    elif extensao in (".flac", ".ogg", ".opus"):
+        import mutagen
+        audio = mutagen.File(caminho)
+        if extensao == ".opus":
+            # RFC 7845: ganho em Q7.8 relativo a -23 LUFS, sem picos
+            valores = {f"r128_{nome}_gain": str(round((REFERENCIA_R128 - loudness) * 256))
+                       for nome, (loudness, _) in medidas.items()}
+        if audio.tags is None:
+            audio.add_tags()
+        audio.tags.update({chave: [valor] for chave, valor in valores.items()})
+        audio.save(padding=_folga_tags)
+    elif extensao == ".m4a":
+        from mutagen.mp4 import MP4, MP4FreeForm
+        audio = MP4(caminho)
+        if audio.tags is None:
+            audio.add_tags()
+        for chave, valor in valores.items():
+            audio.tags[f"----:com.apple.iTunes:{chave}"] = [MP4FreeForm(valor.encode("utf-8"))]
+        audio.save(padding=_folga_tags)
+
+
+def detectar_silencio(ffmpeg: str, caminho: str):
+    """Trecho útil (início, fim) em segundos, sem o silêncio das pontas.
+
+    Uma passada do filtro silencedetect sobre a fonte. Retorna None se
+    não houver o que aparar, se o ffmpeg falhar ou se a duração for
+    desconhecida.
+    """
+    try:
+        resultado = subprocess.run(
+            [ffmpeg, "-nostdin", "-hide_banner", "-nostats", "-i", caminho, "-map", "0:a:0",
+             "-af", f"silencedetect=n={SILENCIO_DB}dB:d={SILENCIO_MIN_S}", "-f", "null", "-"],
+            capture_output=True, creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+    except OSError:
+        return None
+    saida = resultado.stderr.decode("utf-8", "replace")
+    duracao = re.search(r"Duration: (\d+):(\d+):([\d.]+)", saida)
+    if resultado.returncode != 0 or not duracao:
+        return None
+    horas, minutos, segundos = duracao.groups()
+    duracao = int(horas) * 3600 + int(minutos) * 60 + float(segundos)
+    inicio, fim = 0.0, duracao
+    silencios = [(float(a), float(b)) for a, b in re.findall(
+        r"silence_start: (-?[\d.]+).*?silence_end: (-?[\d.]+)", saida, re.S)]
+    if silencios and silencios[0][0] <= 0.1:
+        inicio = max(silencios[0][1] - MARGEM_SILENCIO_S, 0.0)
+    if silencios and silencios[-1][1] >= fim - 0.1 and silencios[-1][0] > inicio:
+        fim = min(silencios[-1][0] + MARGEM_SILENCIO_S, fim)
+    return (inicio, fim) if inicio > 0 or fim < duracao else None
+
+
+def _gravar_gapless(arquivo: Path, duracao: float, atraso: int):
+    """Grava o iTunSMPB (priming, padding e amostras reais) de um M4A.
+
+    O MP3 já leva atraso e padding no cabeçalho LAME e o Opus no
+    pre-skip; o AAC só toca sem emendas com esta tag.
+    """
+    from mutagen.mp4 import MP4, MP4FreeForm
+    audio = MP4(arquivo)
+    taxa = audio.info.sample_rate
+    amostras = round(duracao * taxa)
+    preenchimento = max(round(audio.info.length * taxa) - atraso - amostras, 0)
+    valor = f" 00000000 {atraso:08X} {preenchimento:08X} {amostras:016X}" + " 00000000" * 8
+    if audio.tags is None:
+        audio.add_tags()
+    audio.tags["----:com.apple.iTunes:iTunSMPB"] = [MP4FreeForm(valor.encode("ascii"))]
+    audio.save(padding=_folga_tags)
+
+
+def _pipeline_musica(downloader, musica, arquivo: Path, emitir, contexto: dict,
+                     opcoes: dict) -> Path:
+    """Procura, baixa, converte e marca uma música dentro do worker.
+
+    A fonte vai para `dados/staging` (ou para a pasta de rascunho, se
+    configurada) via `baixar_retomavel`, pela sessão HTTP do worker, então
+    um cancelamento ou queda de conexão preserva o parcial para a próxima
+    tentativa em vez de jogar fora os bytes já baixados. Formatos que não
+    são um arquivo simples (HLS/DASH) ficam com o yt-dlp, sem retomada.
+    Capa e letra são buscadas em paralelo ao download. A saída é montada
+    em `PASTA_TEMPORARIA` e só entra no destino completa.
+    """
+    from spotdl.providers.audio.base import AudioProvider
+    from spotdl.utils.config import get_temp_path
+    from spotdl.utils.ffmpeg import convert
+
+    settings = downloader.settings
+    ffmpeg = getattr(downloader, "ffmpeg", settings["ffmpeg"])
+    # A capa vem do cache (ou é buscada e reduzida) enquanto o áudio baixa
+    capa = None
+    if musica.cover_url and not settings.get("skip_album_art"):
+        capa = _cache_capas(contexto, opcoes, ffmpeg).preparar(musica.cover_url)
+    if not musica.download_url:
+        emitir(tipo="progresso", progresso=0, mensagem="Procurando fonte")
+        musica.download_url = downloader.search(musica)
+        if not musica.download_url:
+            raise LookupError("Nenhuma fonte de áudio encontrada")
+    # Letra como no search_and_download do spotdl; falha só deixa sem letra
+    letra = None
+    if not musica.lyrics:
+        if "letras" not in contexto:
+            contexto["letras"] = ThreadPoolExecutor(max_workers=1)
+        letra = contexto["letras"].submit(downloader.search_lyrics, musica)
+
+    chave_provedor = ("provedor", settings["format"])
+    if chave_provedor not in contexto:
+        contexto[chave_provedor] = AudioProvider(
+            output_format=settings["format"],
+            cookie_file=settings.get("cookie_file"),
+            search_query=settings.get("search_query"),
+            filter_results=settings.get("filter_results", True),
+            yt_dlp_args=settings.get("yt_dlp_args"),
+        )
+    info = contexto[chave_provedor].get_download_metadata(musica.download_url, download=False)
+
+    if info.get("url") and info.get("protocol", "https") in ("http", "https"):
+        staging = Path(opcoes["staging"]) if opcoes.get("staging") else _pasta_dados() / "staging"
+        staging.mkdir(parents=True, exist_ok=True)
+        fonte = staging / f"{info['id']}-{info.get('format_id', 'audio')}.{info['ext']}"
+        baixar_retomavel(
+            info["url"], fonte, info.get("http_headers"),
+            lambda baixados, total: emitir(tipo="progresso", progresso=baixados * 50 / total,
+                                           mensagem="Baixando"),
+            segmentos=opcoes.get("segmentos", 1),
+            segmento_min=int(opcoes.get("segmento_min_mb", 8) * 2**20),
+            sessao=_sessao_http(contexto))
+    else:
+        # Manifesto HLS/DASH: o yt-dlp baixa e junta os fragmentos
+        emitir(tipo="progresso", progresso=0, mensagem="Baixando")
+        info = contexto[chave_provedor].get_download_metadata(musica.download_url, download=True)
+        fonte = Path(get_temp_path()) / f"{info['id']}.{info['ext']}"
+
+    # Silêncio nas pontas sai na própria conversão (-ss/-t de saída), sem
+    # uma segunda codificação
+    ffmpeg_args = shlex.split(settings["ffmpeg_args"]) if settings.get("ffmpeg_args") else []
+    trecho = None
+    if opcoes.get("aparar_silencio"):
+        emitir(tipo="progresso", progresso=50, mensagem="Procurando silêncio")
+        trecho = detectar_silencio(ffmpeg, str(fonte))
+    if trecho:
+        ffmpeg_args += ["-ss", f"{trecho[0]:.3f}", "-t", f"{trecho[1] - trecho[0]:.3f}"]
+        if settings["format"] == "mp3":
+            ffmpeg_args += ["-write_xing", "1"]
+
+    # Converte e marca num temporário no mesmo volume; o destino só recebe
+    # o arquivo pronto, via rename atômico
+    temporario = _arquivo_temporario(opcoes["temporarios"], musica, settings["format"])
+    temporario.parent.mkdir(parents=True, exist_ok=True)
+    sucesso, resultado = convert(
+        input_file=fonte,
+        output_file=temporario,
+        ffmpeg=ffmpeg,
+        output_format=settings["format"],
+        bitrate=settings["bitrate"],
+        ffmpeg_args=ffmpeg_args or None,
+        progress_handler=lambda progresso: emitir(tipo="progresso", progresso=50 + progresso / 2,
+                                                  mensagem="Convertendo"),
+    )
+    if not sucesso:
+        detalhe = str((resultado or {}).get("error") or "")[-200:]
+        raise RuntimeError(f"ffmpeg falhou ao converter {fonte.name} {detalhe}".strip())
+
+    emitir(tipo="progresso", progresso=100, mensagem="Gravando tags")
+    if letra:
+        try:
+            musica.lyrics = letra.result() or musica.lyrics
+        except Exception:
+            pass
+    _gravar_tags(temporario, musica, capa.result() if capa else None)
+    if trecho and settings["format"] == "m4a":
+        _gravar_gapless(temporario, trecho[1] - trecho[0], ATRASO_AAC.get(opcoes.get("encoder"), 1024))
+    fonte.unlink()
+    if opcoes.get("adiar_envio"):
+        # O motor faz o envio ao destino fora do worker
+        return temporario
+    return mover_atomico(temporario, arquivo)
+
+
+def _musica_parcial(faixa: dict) -> dict:
+    """Música mínima a partir de uma faixa da API do Spotify.
+
+    Só o necessário para fila, checkpoint e estimativas; o resto dos
+    metadados é buscado no prefetch (`Song.from_url`).
+    """
+    artistas = [a["name"] for a in faixa.get("artists", [])]
+    return {
+        "parcial": True,
+        "url": faixa["external_urls"]["spotify"],
+        "song_id": faixa["id"],
+        "name": faixa["name"],
+        "artist": artistas[0] if artistas else "",
+        "artists": artistas,
+        "duration": faixa.get("duration_ms", 0) / 1000,
+        "album_name": (faixa.get("album") or {}).get("name"),
+        "isrc": (faixa.get("external_ids") or {}).get("isrc"),
+    }
+
+
+def _paginas_spotify(spotdl, url: str):
+    """Gera (total, músicas parciais) de um álbum/playlist, página a página.
+
+    Outros links (ex.: spotify.link) seguem pela busca do spotdl, que
+    devolve tudo de uma vez.
+    """
+    from spotdl.utils.spotify import SpotifyClient
+
+    cliente = SpotifyClient()
+    if "/playlist/" in url:
+        pagina = cliente.playlist_items(url, additional_types=("track",))
+        faixas = lambda itens: [item.get("track") for item in itens]
+    elif "/album/" in url:
+        pagina = cliente.album_tracks(url)
+        faixas = lambda itens: itens
+    else:
+        musicas = spotdl.search([url])
+        yield len(musicas), [m.json for m in musicas]
+        return
+
+    while pagina:
+        yield pagina["total"], [
+            _musica_parcial(faixa) for faixa in faixas(pagina["items"])
+            if faixa and faixa.get("id") and not faixa.get("is_local")
+        ]
+        pagina = cliente.next(pagina) if pagina.get("next") else None
+
+
+def _mesma_gravacao(tags: dict, faixa: dict) -> bool:
+    """Confere se uma faixa do Spotify corresponde às tags de um arquivo.
+
+    ISRC igual basta; sem ele, título e artista principal normalizados
+    precisam bater e a duração (se conhecida) diferir em até 3 s.
+    """
+    isrc = (faixa.get("external_ids") or {}).get("isrc")
+    if tags.get("isrc") and isrc:
+        return tags["isrc"].upper() == isrc.upper()
+    if _normalizar(faixa.get("name")) != _normalizar(tags.get("titulo")):
+        return False
+    artistas = [_normalizar(a["name"]) for a in faixa.get("artists", [])]
+    if not artistas or artistas[0] not in _normalizar(tags.get("artistas")):
+        return False
+    duracao = faixa.get("duration_ms", 0) / 1000
+    return not tags.get("duracao") or abs(duracao - tags["duracao"]) <= 3
+
+
+def _identificar_faixa(cliente, tags: dict):
+    """Música parcial do Spotify para as tags de um arquivo, ou None."""
+    consultas = []
+    if tags.get("isrc"):
+        consultas.append(f"isrc:{tags['isrc']}")
+    if tags.get("titulo"):
+        consultas.append(f"{tags['titulo']} {tags.get('artistas') or ''}".strip())
+    for consulta in consultas:
+        try:
+            resultado = cliente.search(consulta, type="track", limit=5)
+        except Exception:
+            continue
+        for faixa in ((resultado or {}).get("tracks") or {}).get("items", []):
+            if faixa and faixa.get("id") and _mesma_gravacao(tags, faixa):
+                return _musica_parcial(faixa)
+    return None
+
+
+def _nome_colecao(url: str):
+    """Nome do álbum ou playlist (None para outros links ou se a API falhar)."""
+    from spotdl.utils.spotify import SpotifyClient
+
+    try:
+        if "/playlist/" in url:
+            return SpotifyClient().playlist(url, fields="name")["name"]
+        if "/album/" in url:
+            return SpotifyClient().album(url)["name"]
+    except Exception:
+        pass
+    return None
+
+
+def executar_worker():
+    """Loop do processo worker (`baixafy_motor.py --worker`).
+
+    Importa o spotdl e cria o cliente do Spotify uma única vez, depois
+    atende comandos recebidos como linhas JSON no stdin:
+
+    - ``expandir``: pagina a URL (álbum ou playlist), emitindo músicas
+      parciais página a página;
+    - ``resolver``: encontra a fonte de áudio de uma música (prefetch);
+    - ``baixar``: baixa uma música já resolvida;
+    - ``identificar``: procura no Spotify as faixas de tags lidas de
+      arquivos locais (adoção de biblioteca).
+
+    Eventos voltam como linhas JSON no stdout original; qualquer print do
+    spotdl vai para o stderr, para não corromper o protocolo.
+    """
+    canal = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8", buffering=1)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    atual = {"id": None}
+
+    def emitir(**evento):
+        evento.setdefault("id", atual["id"])
+        canal.write(json.dumps(evento) + "\n")
+
+    try:
+        import logging
+        from spotdl import Spotdl
+        from spotdl.types.song import Song
+        from spotdl.utils.config import DEFAULT_CONFIG
+        from spotdl.utils.formatter import create_file_name
+    except Exception as e:
+        emitir(tipo="indisponivel", erro=str(e))
+        return
+
+    # Pipeline própria (staging retomável) depende de módulos internos do
+    # spotdl; se a versão instalada não os tiver, usa search_and_download
+    try:
+        for modulo in ("spotdl.providers.audio.base", "spotdl.utils.ffmpeg",
+                       "spotdl.utils.metadata"):
+            importlib.import_module(modulo)
+        pipeline_propria = True
+    except ImportError:
+        pipeline_propria = False
+
+    class HandlerEventos(logging.Handler):
+        """Repassa o log do spotdl ao processo da interface."""
+        def emit(self, record):
+            emitir(tipo="log", texto=self.format(record))
+
+    def ao_progresso(rastreador, mensagem):
+        """Callback do ProgressHandler do spotdl (progresso por música)."""
+        emitir(tipo="progresso", progresso=getattr(rastreador, "progress", 0),
+               mensagem=mensagem)
+
+    def carregar_musica(dados: dict):
+        """Song completa (músicas parciais da expansão são buscadas por URL)."""
+        if dados.get("parcial"):
+            return Song.from_url(dados["url"])
+        return Song.from_dict(dados)
+
+    def template_saida(musica, opcoes: dict) -> str:
+        """Template de saída do job para a música (com a subpasta do prefixo)."""
+        template = cliente_spotdl.downloader.settings["output"]
+        if opcoes.get("organizacao") == "prefixo":
+            prefixo = hashlib.sha1(musica.song_id.encode("utf-8")).hexdigest()[:2]
+            template = str(Path(template).parent / prefixo / Path(template).name)
+        return template
+
+    def arquivo_previsto(musica, opcoes: dict) -> Path:
+        """Caminho de saída que o spotdl daria à música, já no layout do job."""
+        settings = cliente_spotdl.downloader.settings
+        return create_file_name(
+            musica, template_saida(musica, opcoes), settings["format"],
+            restrict=settings.get("restrict"),
+            file_name_length=settings.get("max_filename_length"))
+
+    logger = logging.getLogger("spotdl")
+    logger.setLevel(logging.INFO)
+    logger.addHandler(HandlerEventos())
+    cliente_spotdl = None
+    contexto = {}
+    emitir(tipo="pronto")
+
+    for linha in sys.stdin:
+        if not linha.strip():
+            continue
+        comando = json.loads(linha)
+        atual["id"] = comando["id"]
+        try:
+            config = comando.get("config", {})
+            if cliente_spotdl is None:
+                cliente_spotdl = Spotdl(
+                    DEFAULT_CONFIG["client_id"],
+                    DEFAULT_CONFIG["client_secret"],
+                    downloader_settings=dict(config, simple_tui=True),
+                )
+                cliente_spotdl.downloader.progress_handler.update_callback = ao_progresso
+            cliente_spotdl.downloader.settings.update(config)
+
+            if comando["cmd"] == "expandir":
+                nome = _nome_colecao(comando["url"])
+                if nome:
+                    emitir(tipo="colecao", nome=nome)
+                for total, musicas in _paginas_spotify(cliente_spotdl, comando["url"]):
+                    emitir(tipo="faixas", total=total, musicas=musicas)
+                emitir(tipo="fim", codigo=0, memoria_mb=_memoria_processo_mb())
+            elif comando["cmd"] == "identificar":
+                from spotdl.utils.spotify import SpotifyClient
+                cliente = SpotifyClient()
+                emitir(tipo="fim", codigo=0,
+                       musicas=[_identificar_faixa(cliente, tags) for tags in comando["tags"]],
+                       memoria_mb=_memoria_processo_mb())
+            elif comando["cmd"] == "resolver":
+                musica = carregar_musica(comando["musica"])
+                previsto = arquivo_previsto(musica, comando.get("opcoes", {}))
+                if not musica.download_url and not previsto.exists():
+                    musica.download_url = cliente_spotdl.downloader.search(musica)
+                    settings = cliente_spotdl.downloader.settings
+                    if pipeline_propria and musica.cover_url and not settings.get("skip_album_art"):
+                        # Deixa a capa no cache de disco antes do download
+                        _cache_capas(contexto, comando.get("opcoes", {}),
+                                     getattr(cliente_spotdl.downloader, "ffmpeg", settings["ffmpeg"])
+                                     ).preparar(musica.cover_url)
+                encontrada = bool(musica.download_url) or previsto.exists()
+                emitir(tipo="fim", codigo=0 if encontrada else 1, musica=musica.json,
+                       erro="" if encontrada else "Nenhuma fonte de áudio encontrada",
+                       memoria_mb=_memoria_processo_mb())
+            elif comando["cmd"] == "baixar":
+                musica = carregar_musica(comando["musica"])
+                previsto = arquivo_previsto(musica, comando.get("opcoes", {}))
+                # Na pipeline própria o destino só recebe arquivos completos,
+                # então o que já existe lá é confiável; o que está sendo
+                # escrito (e deve sumir num cancelamento) é o temporário
+                existia = previsto.exists()
+                em_escrita = previsto
+                if pipeline_propria and not existia:
+                    em_escrita = _arquivo_temporario(comando["opcoes"]["temporarios"], musica,
+                                                     cliente_spotdl.downloader.settings["format"])
+                emitir(tipo="inicio", arquivo=str(em_escrita), existia=existia)
+                erro = ""
+                envio = None
+                if existia:
+                    arquivo = previsto
+                elif pipeline_propria:
+                    arquivo = _pipeline_musica(cliente_spotdl.downloader, musica, previsto, emitir,
+                                               contexto, comando.get("opcoes", {}))
+                    if arquivo != previsto:
+                        # Pronto no rascunho; o motor envia ao destino
+                        envio = str(previsto)
+                else:
+                    # O spotdl monta o caminho pelo template: o prefixo da
+                    # música entra nele só durante este download
+                    settings = cliente_spotdl.downloader.settings
+                    template = settings["output"]
+                    settings["output"] = template_saida(musica, comando.get("opcoes", {}))
+                    try:
+                        musica, arquivo = cliente_spotdl.downloader.search_and_download(musica)
+                    finally:
+                        settings["output"] = template
+                    erros = cliente_spotdl.downloader.errors
+                    erro = erros[-1] if erros else "Falha no download"
+                emitir(tipo="fim", codigo=0 if arquivo else 1,
+                       arquivo=str(arquivo) if arquivo else None,
+                       erro="" if arquivo else erro, envio=envio, musica=musica.json,
+                       memoria_mb=_memoria_processo_mb())
+        except Exception as e:
+            emitir(tipo="fim", codigo=1, erro=str(e), memoria_mb=_memoria_processo_mb())
+
+
+def _id_musica(musica: dict) -> str:
+    """Identificador estável de uma música serializada pelo spotdl."""
+    return musica.get("song_id") or musica.get("url", "")
+
+
+def _nome_musica(musica: dict) -> str:
+    """Nome de exibição de uma música serializada pelo spotdl."""
+    return f"{musica.get('artist', '?')} - {musica.get('name', '?')}"
+
+
+class WorkerSpotdl:
+    """Processo worker de longa duração, com o spotdl já importado."""
+
+    def __init__(self, espera_cancelamento: float = 5.0):
+        """Cria o worker; o processo só sobe em `iniciar`."""
+        self.processo = None
+        self.pronto = False
+        self.morto = False
+        self.encerramento = None
+        self.espera_cancelamento = espera_cancelamento
+        self.jobs_feitos = 0
+        self.memoria_mb = 0.0
+
+    async def iniciar(self) -> bool:
+        """Sobe o processo e aguarda o spotdl terminar de importar."""
+        self.processo = await asyncio.create_subprocess_exec(
+            sys.executable, str(Path(__file__).resolve()), "--worker",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            limit=2**24,
+            **_opcoes_grupo_processo()
+        )
+        evento = await self._ler()
+        self.pronto = bool(evento) and evento["tipo"] == "pronto"
+        return self.pronto
+
+    async def _ler(self):
+        """Lê o próximo evento do worker (None se o processo saiu)."""
+        linha = await self.processo.stdout.readline()
+        return json.loads(linha) if linha else None
+
+    def vivo(self) -> bool:
+        """Indica se o processo ainda está rodando."""
+        return (self.processo is not None and not self.morto
+                and self.processo.returncode is None)
+
+    async def comando(self, comando: dict, ao_evento) -> dict:
+        """Envia um comando e repassa os eventos até o evento de fim.
+
+        Se o processo morrer no meio (ex.: cancelamento), devolve um
+        evento de fim com o código de saída dele.
+        """
+        try:
+            self.processo.stdin.write((json.dumps(comando) + "\n").encode("utf-8"))
+            await self.processo.stdin.drain()
+            while True:
+                evento = await self._ler()
+                if evento is None:
+                    codigo = await self.processo.wait()
+                    return {"tipo": "fim", "codigo": codigo or 1,
+                            "erro": f"Worker saiu com código {codigo}"}
+                if evento["tipo"] == "fim":
+                    self.jobs_feitos += 1
+                    self.memoria_mb = evento.get("memoria_mb", 0.0)
+                    return evento
+                ao_evento(evento)
+        except BaseException:
+            # Cancelado (ou erro ao tratar um evento) no meio de um comando:
+            # o worker ficou dessincronizado e não dá para reaproveitar
+            self.matar(self.espera_cancelamento)
+            raise
+
+    def matar(self, espera: float = 5.0):
+        """Agenda o encerramento da árvore do worker (em `encerramento`)."""
+        if self.vivo():
+            self.morto = True
+            self.encerramento = asyncio.ensure_future(
+                encerrar_arvore_processos(self.processo, espera))
+        return self.encerramento
+
+    async def encerrar(self):
+        """Fecha o stdin (fim do loop) e garante que o processo saia."""
+        if not self.vivo():
+            return
+        try:
+            self.processo.stdin.close()
+            await asyncio.wait_for(self.processo.wait(), timeout=5)
+        except Exception:
+            encerramento = self.matar()
+            if encerramento:
+                await encerramento
+
+
+class PoolWorkers:
+    """Pool de workers spotdl aquecidos, reciclados por uso e memória."""
+
+    def __init__(self, config: dict, tamanho: int = None):
+        """Cria pool vazio; workers são iniciados sob demanda ou em `aquecer`."""
+        self.tamanho = max(1, int(config["workers"] if tamanho is None else tamanho))
+        self.jobs_por_worker = int(config["jobs_por_worker"])
+        self.memoria_max_mb = float(config["memoria_max_worker_mb"])
+        self.espera_cancelamento = float(config["espera_cancelamento_s"])
+        self.disponivel = True
+        self._livres = []
+        self._vagas = asyncio.Semaphore(self.tamanho)
+
+    async def aquecer(self):
+        """Deixa um worker pronto antes do primeiro job."""
+        worker = await self.obter()
+        if worker:
+            self.devolver(worker)
+
+    async def obter(self):
+        """Obtém worker livre (ou cria um); None se o spotdl não importa."""
+        if not self.disponivel:
+            return None
+        await self._vagas.acquire()
+        while self._livres:
+            worker = self._livres.pop()
+            if worker.vivo():
+                return worker
+
+        worker = WorkerSpotdl(self.espera_cancelamento)
+        if await worker.iniciar():
+            return worker
+        await worker.encerrar()
+        self.disponivel = False
+        self._vagas.release()
+        return None
+
+    def devolver(self, worker: WorkerSpotdl):
+        """Devolve worker ao pool, reciclando se passou dos limites."""
+        reciclar = (
+            not worker.vivo()
+            or worker.jobs_feitos >= self.jobs_por_worker
+            or (self.memoria_max_mb and worker.memoria_mb > self.memoria_max_mb)
+        )
+        if reciclar:
+            asyncio.ensure_future(worker.encerrar())
+        else:
+            self._livres.append(worker)
+        self._vagas.release()
+
+    async def encerrar(self):
+        """Encerra todos os workers livres."""
+        livres, self._livres = self._livres, []
+        for worker in livres:
+            await worker.encerrar()
+
+
+def estimar_tamanho(duracao_s: float, perfil: dict) -> int:
+    """Tamanho estimado (bytes) de uma música no perfil dado.
+
+    Áudio pela taxa de bits do perfil mais uma folga fixa para tags e
+    capa embutida. Sem duração conhecida, assume uma música média.
+    """
+    bitrate = int(perfil["bitrate"].rstrip("k")) * 1000
+    return int((duracao_s or DURACAO_PADRAO_S) * bitrate / 8) + SOBRECARGA_ARQUIVO
+
+
+class ReservasDisco:
+    """Reservas de espaço em disco dos jobs em andamento, por volume.
+
+    Cada música enfileirada reserva o tamanho estimado; a reserva sai
+    quando a música termina (o arquivo passa a ocupar o espaço de fato)
+    ou quando o job acaba. Assim jobs simultâneos no mesmo volume não
+    contam duas vezes com o mesmo espaço livre.
+    """
+
+    def __init__(self, margem: int):
+        """`margem`: bytes que devem sobrar livres no volume."""
+        self.margem = margem
+        self._reservas = {}
+        self._trava = threading.Lock()
+
+    def livre(self, pasta: str) -> int:
+        """Espaço livre no volume de `pasta` descontadas margem e reservas."""
+        volume = os.stat(pasta).st_dev
+        with self._trava:
+            reservado = sum(t for (v, _, _), t in self._reservas.items() if v == volume)
+        return shutil.disk_usage(pasta).free - self.margem - reservado
+
+    def reservar(self, pasta: str, job: int, indice: int, tamanho: int) -> bool:
+        """Reserva `tamanho` bytes para a música, se couber no volume."""
+        volume = os.stat(pasta).st_dev
+        with self._trava:
+            reservado = sum(t for (v, _, _), t in self._reservas.items() if v == volume)
+            if shutil.disk_usage(pasta).free - self.margem - reservado < tamanho:
+                return False
+            self._reservas[(volume, job, indice)] = tamanho
+            return True
+
+    def liberar(self, job: int, indice: int = None):
+        """Libera a reserva de uma música (ou de todas do job)."""
+        with self._trava:
+            for chave in list(self._reservas):
+                if chave[1] == job and indice in (None, chave[2]):
+                    del self._reservas[chave]
+
+
+# Pares baratos de duplicatas: mesmo id do Spotify, mesmo ISRC, mesmo
+# conteúdo (hash) ou mesmo artista + título normalizados com até 3 s de
+# diferença de duração (faixas de 4 s, vizinhas incluídas, usam o índice).
+# `filtro` escolhe entre um arquivo só ou a tabela inteira.
+PARES_BARATOS_SQL = """
+    INSERT OR IGNORE INTO duplicatas
+    SELECT min(a.caminho, b.caminho), max(a.caminho, b.caminho), 'spotify', 0
+        FROM arquivos a JOIN arquivos b ON b.song_id = a.song_id AND b.caminho != a.caminho
+        WHERE {filtro} AND a.song_id IS NOT NULL
+    UNION ALL
+    SELECT min(a.caminho, b.caminho), max(a.caminho, b.caminho), 'isrc', 0
+        FROM arquivos a JOIN arquivos b ON b.isrc = a.isrc AND b.caminho != a.caminho
+        WHERE {filtro} AND a.isrc IS NOT NULL
+    UNION ALL
+    SELECT min(a.caminho, b.caminho), max(a.caminho, b.caminho), 'hash', 0
+        FROM arquivos a JOIN arquivos b ON b.hash = a.hash AND b.caminho != a.caminho
+        WHERE {filtro} AND a.hash IS NOT NULL
+    UNION ALL
+    SELECT min(a.caminho, b.caminho), max(a.caminho, b.caminho), 'tags',
+           abs(a.duracao - b.duracao)
+        FROM arquivos a JOIN arquivos b ON b.chave_tags = a.chave_tags
+            AND b.faixa_duracao BETWEEN a.faixa_duracao - 1 AND a.faixa_duracao + 1
+            AND b.caminho != a.caminho
+        WHERE {filtro} AND a.chave_tags IS NOT NULL AND abs(a.duracao - b.duracao) <= 3;
+"""
+
+
+def _chave_tags(artistas: str, titulo: str):
+    """Artista principal + título normalizados ("artista|título"), ou None."""
+    if not titulo:
+        return None
+    return f"{_normalizar((artistas or '').split(',')[0])}|{_normalizar(titulo)}"
+
+
+class Biblioteca:
+    """Índice SQLite das músicas já baixadas (`dados/biblioteca.db`).
+
+    Guarda onde cada arquivo de cada música está, por pasta raiz e
+    formato; saber se uma música já existe custa uma consulta e um stat,
+    nunca uma listagem de pastas, qualquer que seja o layout.
+    """
+
+    ESQUEMA = """
+        CREATE TABLE IF NOT EXISTS arquivos (
+            caminho TEXT PRIMARY KEY,
+            raiz TEXT NOT NULL,
+            song_id TEXT,
+            formato TEXT,
+            titulo TEXT,
+            artistas TEXT,
+            album TEXT,
+            isrc TEXT,
+            duracao REAL,
+            tamanho INTEGER,
+            mtime_ns INTEGER,
+            adicionado REAL
+        );
+        CREATE INDEX IF NOT EXISTS arquivos_musica ON arquivos (song_id, raiz, formato);
+        CREATE TABLE IF NOT EXISTS pastas (
+            caminho TEXT PRIMARY KEY,
+            raiz TEXT NOT NULL,
+            pai TEXT,
+            mtime_ns INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS impressoes (
+            id INTEGER PRIMARY KEY,
+            caminho TEXT UNIQUE,
+            mtime_ns INTEGER,
+            dados BLOB
+        );
+        CREATE TABLE IF NOT EXISTS chaves_impressao (
+            chave INTEGER,
+            impressao INTEGER,
+            quadro INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS chaves_impressao_chave ON chaves_impressao (chave);
+        CREATE TABLE IF NOT EXISTS duplicatas (
+            caminho_a TEXT,
+            caminho_b TEXT,
+            metodo TEXT,
+            distancia REAL,
+            PRIMARY KEY (caminho_a, caminho_b, metodo)
+        );
+        CREATE TABLE IF NOT EXISTS playlists (
+            url TEXT PRIMARY KEY,
+            nome TEXT
+        );
+        CREATE TABLE IF NOT EXISTS playlist_musicas (
+            playlist TEXT,
+            song_id TEXT,
+            PRIMARY KEY (playlist, song_id)
+        );
+        CREATE INDEX IF NOT EXISTS playlist_musicas_song ON playlist_musicas (song_id);
+    """
+
+    # Busca textual (FTS5), mantida por gatilhos a cada mudança em arquivos
+    # ou nas playlists; o rowid de `busca` é o de `arquivos`. Se o SQLite
+    # não tiver FTS5, `buscar` cai para LIKE.
+    PLAYLISTS_DA_MUSICA = """(SELECT group_concat(coalesce(p.nome, p.url), ' ')
+        FROM playlist_musicas m JOIN playlists p ON p.url = m.playlist
+        WHERE m.song_id = {musica}.song_id)"""
+    BUSCA = f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS busca USING fts5(
+            titulo, artistas, album, playlists, tokenize="unicode61 remove_diacritics 2");
+        CREATE TRIGGER IF NOT EXISTS busca_insere AFTER INSERT ON arquivos BEGIN
+            INSERT INTO busca (rowid, titulo, artistas, album, playlists) VALUES (
+                new.rowid, new.titulo, new.artistas, new.album,
+                {PLAYLISTS_DA_MUSICA.format(musica="new")});
+        END;
+        CREATE TRIGGER IF NOT EXISTS busca_apaga AFTER DELETE ON arquivos BEGIN
+            DELETE FROM busca WHERE rowid = old.rowid;
+        END;
+        CREATE TRIGGER IF NOT EXISTS busca_atualiza
+        AFTER UPDATE OF titulo, artistas, album, song_id ON arquivos BEGIN
+            DELETE FROM busca WHERE rowid = old.rowid;
+            INSERT INTO busca (rowid, titulo, artistas, album, playlists) VALUES (
+                new.rowid, new.titulo, new.artistas, new.album,
+                {PLAYLISTS_DA_MUSICA.format(musica="new")});
+        END;
+        CREATE TRIGGER IF NOT EXISTS busca_playlist AFTER INSERT ON playlist_musicas BEGIN
+            DELETE FROM busca WHERE rowid IN (SELECT rowid FROM arquivos WHERE song_id = new.song_id);
+            INSERT INTO busca (rowid, titulo, artistas, album, playlists)
+                SELECT rowid, titulo, artistas, album, {PLAYLISTS_DA_MUSICA.format(musica="arquivos")}
+                FROM arquivos WHERE song_id = new.song_id;
+        END;
+    """
+
+    # Alterações de tabelas já existentes; `PRAGMA user_version` guarda
+    # quantas já foram aplicadas
+    MIGRACOES = [
+        "ALTER TABLE arquivos ADD COLUMN pasta TEXT;"
+        "UPDATE arquivos SET pasta = dirname(caminho);"
+        "CREATE INDEX arquivos_pasta ON arquivos (pasta);",
+        "ALTER TABLE arquivos ADD COLUMN hash TEXT;"
+        "ALTER TABLE arquivos ADD COLUMN adotado INTEGER NOT NULL DEFAULT 0;",
+        "ALTER TABLE arquivos ADD COLUMN chave_tags TEXT;"
+        "ALTER TABLE arquivos ADD COLUMN faixa_duracao INTEGER;"
+        "UPDATE arquivos SET chave_tags = chave_tags(artistas, titulo), "
+        "faixa_duracao = CAST(duracao / 4 AS INTEGER);"
+        "CREATE INDEX arquivos_tags ON arquivos (chave_tags, faixa_duracao);"
+        "CREATE INDEX arquivos_isrc ON arquivos (isrc);"
+        "CREATE INDEX arquivos_hash ON arquivos (hash);"
+        + PARES_BARATOS_SQL.format(filtro="a.caminho < b.caminho"),
+        "ALTER TABLE arquivos ADD COLUMN lufs REAL;"
+        "ALTER TABLE arquivos ADD COLUMN pico REAL;",
+        # Chaves de impressão passaram a 32 bits: as antigas são refeitas
+        "DELETE FROM chaves_impressao;"
+        "DELETE FROM impressoes;",
+    ]
+
+    def __init__(self, caminho: Path):
+        self._conexao = sqlite3.connect(str(caminho), check_same_thread=False)
+        self._conexao.create_function("dirname", 1, os.path.dirname, deterministic=True)
+        self._conexao.create_function("chave_tags", 2, _chave_tags, deterministic=True)
+        self._trava = threading.Lock()
+        with self._trava, self._conexao:
+            self._conexao.execute("PRAGMA journal_mode=WAL")
+            self._conexao.execute("PRAGMA synchronous=NORMAL")
+            # INSERT OR REPLACE só dispara o gatilho de exclusão da busca assim
+            self._conexao.execute("PRAGMA recursive_triggers=ON")
+            self._conexao.executescript(self.ESQUEMA)
+            versao = self._conexao.execute("PRAGMA user_version").fetchone()[0]
+            for versao, migracao in enumerate(self.MIGRACOES[versao:], versao + 1):
+                # Migração e versão na mesma transação: uma interrompida no
+                # meio não fica meio aplicada nem é reaplicada sobre si mesma
+                try:
+                    self._conexao.executescript(
+                        f"BEGIN; {migracao}; PRAGMA user_version = {versao}; COMMIT;")
+                except sqlite3.Error:
+                    self._conexao.rollback()
+                    raise
+            nova = not self._conexao.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'busca'").fetchone()
+            try:
+                self._conexao.executescript(self.BUSCA)
+                self.fts = True
+            except sqlite3.OperationalError:
+                self.fts = False
+            if self.fts and nova:
+                self._conexao.execute(
+                    "INSERT INTO busca (rowid, titulo, artistas, album, playlists) "
+                    "SELECT rowid, titulo, artistas, album, "
+                    f"{self.PLAYLISTS_DA_MUSICA.format(musica='arquivos')} FROM arquivos")
+
+    def registrar(self, raiz: str, caminho: str, musica: dict) -> list:
+        """Registra (ou atualiza) o arquivo de uma música.
+
+        Retorna as prováveis duplicatas dela já no índice, de qualquer
+        pasta: [(caminho, método)].
+        """
+        info = os.stat(caminho)
+        caminho = os.path.abspath(caminho)
+        artistas = musica.get("artists") or [musica.get("artist", "")]
+        with self._trava, self._conexao:
+            anterior = self._conexao.execute(
+                "SELECT tamanho, mtime_ns, lufs, pico FROM arquivos WHERE caminho = ?",
+                (caminho,)).fetchone()
+            self._conexao.execute(
+                "INSERT OR REPLACE INTO arquivos (caminho, raiz, song_id, formato, titulo, "
+                "artistas, album, isrc, duracao, tamanho, mtime_ns, adicionado, pasta) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (caminho, os.path.abspath(raiz), _id_musica(musica),
+                 Path(caminho).suffix.lstrip(".").lower(), musica.get("name"),
+                 ", ".join(artistas), musica.get("album_name"), musica.get("isrc"),
+                 musica.get("duration"), info.st_size, info.st_mtime_ns, time.time(),
+                 os.path.dirname(caminho)))
+            if anterior and anterior[:2] == (info.st_size, info.st_mtime_ns):
+                # Mesmo arquivo: a medição de loudness continua valendo
+                self._conexao.execute("UPDATE arquivos SET lufs = ?, pico = ? WHERE caminho = ?",
+                                      (*anterior[2:], caminho))
+            self._atualizar_pares(caminho)
+            return [(a if b == caminho else b, metodo) for a, b, metodo in self._conexao.execute(
+                "SELECT caminho_a, caminho_b, metodo FROM duplicatas "
+                "WHERE caminho_a = ? OR caminho_b = ?", (caminho, caminho))]
+
+    def _atualizar_pares(self, caminho: str):
+        """Recalcula as chaves baratas de um arquivo e seus pares (com a trava)."""
+        self._conexao.execute(
+            "UPDATE arquivos SET chave_tags = chave_tags(artistas, titulo), "
+            "faixa_duracao = CAST(duracao / 4 AS INTEGER) WHERE caminho = ?", (caminho,))
+        self._conexao.execute(
+            "DELETE FROM duplicatas WHERE metodo != 'impressao' "
+            "AND (caminho_a = ? OR caminho_b = ?)", (caminho, caminho))
+        self._conexao.execute(PARES_BARATOS_SQL.format(filtro="a.caminho = :caminho"),
+                              {"caminho": caminho})
+
+    def localizar(self, song_id: str, raiz: str, formato: str):
+        """Caminho da música na raiz e formato dados, ou None.
+
+        Arquivos adotados de uma biblioteca existente valem em qualquer
+        pasta e formato. Entradas cujo arquivo sumiu do disco são
+        descartadas na hora.
+        """
+        with self._trava:
+            linhas = self._conexao.execute(
+                "SELECT caminho FROM arquivos WHERE song_id = ? "
+                "AND ((raiz = ? AND formato = ?) OR adotado = 1)",
+                (song_id, os.path.abspath(raiz), formato)).fetchall()
+        for (caminho,) in linhas:
+            if os.path.exists(caminho):
+                return caminho
+            self.remover(caminho)
+        return None
+
+    def loudness(self, caminho: str):
+        """(lufs, pico) já medidos para o arquivo, ou None."""
+        with self._trava:
+            linha = self._conexao.execute(
+                "SELECT lufs, pico FROM arquivos WHERE caminho = ? AND lufs IS NOT NULL",
+                (os.path.abspath(caminho),)).fetchone()
+        return tuple(linha) if linha else None
+
+    def gravar_loudness(self, caminho: str, lufs: float, pico: float):
+        """Guarda a medição; tamanho e mtime vêm do disco (as tags de ganho
+        acabaram de mudar o arquivo, não o áudio)."""
+        info = os.stat(caminho)
+        with self._trava, self._conexao:
+            self._conexao.execute(
+                "UPDATE arquivos SET lufs = ?, pico = ?, tamanho = ?, mtime_ns = ? "
+                "WHERE caminho = ?",
+                (lufs, pico, info.st_size, info.st_mtime_ns, os.path.abspath(caminho)))
+
+    def possui(self, musica: dict, raiz: str, formato: str):
+        """Caminho de um arquivo que já é esta música, ou None.
+
+        Primeiro pelo id do Spotify (`localizar`); depois, para arquivos
+        ainda não identificados (varridos ou adotados sem match), por
+        artista + título normalizados e duração até 3 s diferente.
+        """
+        caminho = self.localizar(_id_musica(musica), raiz, formato)
+        chave = _chave_tags(", ".join(musica.get("artists") or [musica.get("artist") or ""]),
+                            musica.get("name"))
+        if caminho or not chave or not musica.get("duration"):
+            return caminho
+        faixa = int(musica["duration"] / 4)
+        with self._trava:
+            linhas = self._conexao.execute(
+                "SELECT caminho FROM arquivos WHERE chave_tags = ? "
+                "AND faixa_duracao BETWEEN ? AND ? AND abs(duracao - ?) <= 3 "
+                "AND song_id IS NULL AND ((raiz = ? AND formato = ?) OR hash IS NOT NULL)",
+                (chave, faixa - 1, faixa + 1, musica["duration"], os.path.abspath(raiz),
+                 formato)).fetchall()
+        return next((c for (c,) in linhas if os.path.exists(c)), None)
+
+    def registrar_playlist(self, url: str, nome: str, song_ids: list):
+        """Registra o nome de uma playlist/álbum e músicas que fazem parte dela."""
+        with self._trava, self._conexao:
+            self._conexao.execute(
+                "INSERT INTO playlists VALUES (?, ?) ON CONFLICT (url) DO UPDATE "
+                "SET nome = coalesce(excluded.nome, nome)", (url, nome))
+            self._conexao.executemany("INSERT OR IGNORE INTO playlist_musicas VALUES (?, ?)",
+                                      [(url, song_id) for song_id in song_ids])
+
+    def buscar(self, texto: str, limite: int = 50) -> list:
+        """(caminho, título, artistas, álbum) que casam com todas as palavras.
+
+        Cada palavra vale como prefixo, em título, artistas, álbum ou nome
+        de playlist, sem diferenciar acentos nem caixa.
+        """
+        palavras = re.findall(r"\w+", texto)
+        if not palavras:
+            return []
+        with self._trava:
+            if self.fts:
+                consulta = " ".join(f'"{p}"*' for p in palavras)
+                return self._conexao.execute(
+                    "SELECT a.caminho, a.titulo, a.artistas, a.album FROM busca "
+                    "JOIN arquivos a ON a.rowid = busca.rowid WHERE busca MATCH ? "
+                    "ORDER BY rank LIMIT ?", (consulta, limite)).fetchall()
+            condicao = " AND ".join(
+                "(titulo LIKE ? OR artistas LIKE ? OR album LIKE ?)" for _ in palavras)
+            return self._conexao.execute(
+                f"SELECT caminho, titulo, artistas, album FROM arquivos WHERE {condicao} LIMIT ?",
+                [f"%{p}%" for p in palavras for _ in range(3)] + [limite]).fetchall()
+
+    def remover(self, caminho: str):
+        """Tira um arquivo do índice."""
+        with self._trava, self._conexao:
+            self._conexao.execute("DELETE FROM arquivos WHERE caminho = ?",
+                                  (os.path.abspath(caminho),))
+
+    def pastas(self, raiz: str) -> dict:
+        """Checkpoints da varredura: {pasta: (pai, mtime_ns)} sob a raiz."""
+        with self._trava:
+            return {caminho: (pai, mtime) for caminho, pai, mtime in self._conexao.execute(
+                "SELECT caminho, pai, mtime_ns FROM pastas WHERE raiz = ?",
+                (os.path.abspath(raiz),))}
+
+    def gravar_pasta(self, raiz: str, pasta: str, pai: str, mtime_ns: int, arquivos: list):
+        """Sincroniza os arquivos de áudio diretos de `pasta` e seu checkpoint.
+
+        `arquivos` é uma lista de (caminho, tamanho, mtime_ns). Arquivos
+        novos entram sem metadados; os que mudaram só têm tamanho e mtime
+        atualizados; os que sumiram saem do índice.
+        """
+        raiz = os.path.abspath(raiz)
+        with self._trava, self._conexao:
+            presentes = {caminho for caminho, _, _ in arquivos}
+            self._conexao.executemany(
+                "DELETE FROM arquivos WHERE caminho = ?",
+                [(c,) for (c,) in self._conexao.execute(
+                    "SELECT caminho FROM arquivos WHERE pasta = ?", (pasta,))
+                 if c not in presentes])
+            self._conexao.executemany(
+                "INSERT INTO arquivos (caminho, raiz, formato, tamanho, mtime_ns, adicionado, pasta) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (caminho) DO UPDATE SET "
+                "tamanho = excluded.tamanho, mtime_ns = excluded.mtime_ns, hash = NULL "
+                "WHERE tamanho IS NOT excluded.tamanho OR mtime_ns IS NOT excluded.mtime_ns",
+                [(caminho, raiz, Path(caminho).suffix.lstrip(".").lower(), tamanho, mtime,
+                  time.time(), pasta) for caminho, tamanho, mtime in arquivos])
+            self._conexao.execute(
+                "INSERT OR REPLACE INTO pastas VALUES (?, ?, ?, ?)", (pasta, raiz, pai, mtime_ns))
+
+    @staticmethod
+    def _faixa(pasta: str) -> tuple:
+        """Parâmetros de "caminho = ? OR (caminho >= ? AND caminho < ?)" para
+        tudo dentro de `pasta`; a faixa usa o índice da chave primária."""
+        pasta = os.path.abspath(pasta)
+        abaixo = pasta.rstrip(os.sep) + os.sep
+        return pasta, abaixo, abaixo + "\U0010ffff"
+
+    def esquecer_pasta(self, pasta: str):
+        """Remove do índice uma pasta que sumiu, com tudo o que havia abaixo dela."""
+        faixa = self._faixa(pasta)
+        with self._trava, self._conexao:
+            for tabela in ("arquivos", "pastas"):
+                self._conexao.execute(
+                    f"DELETE FROM {tabela} WHERE caminho = ? OR (caminho >= ? AND caminho < ?)",
+                    faixa)
+
+    def pendentes_adocao(self, pasta: str) -> list:
+        """(caminho, song_id) dos arquivos sob `pasta` ainda sem tags/hash lidos."""
+        with self._trava:
+            return self._conexao.execute(
+                "SELECT caminho, song_id FROM arquivos WHERE hash IS NULL "
+                "AND (caminho = ? OR (caminho >= ? AND caminho < ?))", self._faixa(pasta)).fetchall()
+
+    def identificar(self, itens: list):
+        """Grava tags e hash lidos de arquivos e, se achada, a música do Spotify.
+
+        `itens` é uma lista de (dados lidos, música ou None), gravada numa
+        transação só; os pares baratos de duplicatas do lote inteiro saem
+        de uma consulta, não de uma por arquivo. Metadados do Spotify têm
+        precedência sobre as tags; um song_id já conhecido (arquivo baixado
+        pelo BaixaFy) nunca é trocado.
+        """
+        linhas = []
+        for dados, musica in itens:
+            musica = musica or {}
+            linhas.append((
+                dados["hash"], musica.get("song_id"), musica.get("song_id"),
+                musica.get("name") or dados.get("titulo"),
+                ", ".join(musica["artists"]) if musica.get("artists") else dados.get("artistas"),
+                musica.get("album_name") or dados.get("album"),
+                musica.get("isrc") or dados.get("isrc"),
+                musica.get("duration") or dados.get("duracao"), dados["caminho"]))
+        with self._trava, self._conexao:
+            self._conexao.executemany(
+                "UPDATE arquivos SET hash = ?, song_id = COALESCE(song_id, ?), "
+                "adotado = adotado OR (song_id IS NULL AND ? IS NOT NULL), "
+                "titulo = COALESCE(?, titulo), artistas = COALESCE(?, artistas), "
+                "album = COALESCE(?, album), isrc = COALESCE(?, isrc), "
+                "duracao = COALESCE(?, duracao), chave_tags = NULL WHERE caminho = ?", linhas)
+            self._conexao.execute("CREATE TEMP TABLE IF NOT EXISTS lote (caminho TEXT PRIMARY KEY)")
+            self._conexao.execute("DELETE FROM lote")
+            self._conexao.executemany("INSERT OR IGNORE INTO lote VALUES (?)",
+                                      [(linha[-1],) for linha in linhas])
+            self._conexao.execute(
+                "UPDATE arquivos SET chave_tags = chave_tags(artistas, titulo), "
+                "faixa_duracao = CAST(duracao / 4 AS INTEGER) "
+                "WHERE caminho IN (SELECT caminho FROM lote)")
+            self._conexao.execute(
+                "DELETE FROM duplicatas WHERE metodo != 'impressao' "
+                "AND (caminho_a IN (SELECT caminho FROM lote) OR caminho_b IN (SELECT caminho FROM lote))")
+            self._conexao.execute(PARES_BARATOS_SQL.format(
+                filtro="a.caminho IN (SELECT caminho FROM lote)"))
+
+    def sem_impressao(self, pasta: str) -> list:
+        """(caminho, mtime_ns) dos arquivos sob `pasta` sem impressão atual."""
+        with self._trava:
+            return self._conexao.execute(
+                "SELECT a.caminho, a.mtime_ns FROM arquivos a "
+                "LEFT JOIN impressoes i ON i.caminho = a.caminho "
+                "WHERE (i.id IS NULL OR i.mtime_ns IS NOT a.mtime_ns) "
+                "AND (a.caminho = ? OR (a.caminho >= ? AND a.caminho < ?))",
+                self._faixa(pasta)).fetchall()
+
+    def podar_impressoes(self):
+        """Descarta impressões, chaves e pares de arquivos que saíram do índice."""
+        with self._trava, self._conexao:
+            self._conexao.execute(
+                "DELETE FROM duplicatas WHERE caminho_a NOT IN (SELECT caminho FROM arquivos) "
+                "OR caminho_b NOT IN (SELECT caminho FROM arquivos)")
+            self._conexao.execute(
+                "DELETE FROM chaves_impressao WHERE impressao IN (SELECT id FROM impressoes "
+                "WHERE caminho NOT IN (SELECT caminho FROM arquivos))")
+            self._conexao.execute(
+                "DELETE FROM impressoes WHERE caminho NOT IN (SELECT caminho FROM arquivos)")
+
+    def gravar_impressao(self, caminho: str, mtime_ns: int, impressao: array.array,
+                         chaves: list) -> int:
+        """Grava a impressão de um arquivo e suas chaves; retorna o id."""
+        with self._trava, self._conexao:
+            antiga = self._conexao.execute(
+                "SELECT id FROM impressoes WHERE caminho = ?", (caminho,)).fetchone()
+            if antiga:
+                # Arquivo alterado: a comparação antiga não vale mais
+                self._conexao.execute("DELETE FROM chaves_impressao WHERE impressao = ?", antiga)
+                self._conexao.execute("DELETE FROM impressoes WHERE id = ?", antiga)
+                self._conexao.execute(
+                    "DELETE FROM duplicatas WHERE metodo = 'impressao' "
+                    "AND (caminho_a = ? OR caminho_b = ?)", (caminho, caminho))
+            id_ = self._conexao.execute(
+                "INSERT INTO impressoes (caminho, mtime_ns, dados) VALUES (?, ?, ?)",
+                (caminho, mtime_ns, impressao.tobytes())).lastrowid
+            self._conexao.executemany(
+                "INSERT INTO chaves_impressao VALUES (?, ?, ?)",
+                [(chave, id_, quadro) for chave, quadro in chaves])
+        return id_
+
+    def votar_impressao(self, id_: int, chaves: list) -> dict:
+        """Conta chaves em comum por deslocamento: {id: Counter(deslocamento)}."""
+        quadros = collections.defaultdict(list)
+        for chave, quadro in chaves:
+            quadros[chave].append(quadro)
+        votos = collections.defaultdict(collections.Counter)
+        lista = list(quadros)
+        with self._trava:
+            for i in range(0, len(lista), 500):
+                lote = lista[i:i + 500]
+                for chave, outra, quadro in self._conexao.execute(
+                        "SELECT chave, impressao, quadro FROM chaves_impressao "
+                        f"WHERE impressao != ? AND chave IN ({','.join('?' * len(lote))})",
+                        (id_, *lote)):
+                    for proprio in quadros[chave]:
+                        votos[outra][quadro - proprio] += 1
+        return votos
+
+    def impressao(self, id_: int) -> tuple:
+        """(caminho, impressão) gravados com o id."""
+        with self._trava:
+            caminho, dados = self._conexao.execute(
+                "SELECT caminho, dados FROM impressoes WHERE id = ?", (id_,)).fetchone()
+        impressao = array.array("H")
+        impressao.frombytes(dados)
+        return caminho, impressao
+
+    def registrar_duplicata(self, caminho_a: str, caminho_b: str, metodo: str,
+                            distancia: float):
+        """Registra um par de prováveis duplicatas (ordem do par normalizada)."""
+        caminho_a, caminho_b = sorted((caminho_a, caminho_b))
+        with self._trava, self._conexao:
+            self._conexao.execute("INSERT OR REPLACE INTO duplicatas VALUES (?, ?, ?, ?)",
+                                  (caminho_a, caminho_b, metodo, distancia))
+
+    def duplicatas(self, pasta: str) -> list:
+        """Pares (a, b, método, distância) com algum arquivo sob `pasta`."""
+        faixa = self._faixa(pasta)
+        with self._trava:
+            return self._conexao.execute(
+                "SELECT caminho_a, caminho_b, metodo, distancia FROM duplicatas "
+                "WHERE caminho_a = ? OR (caminho_a >= ? AND caminho_a < ?) "
+                "OR caminho_b = ? OR (caminho_b >= ? AND caminho_b < ?) "
+                "ORDER BY caminho_a, caminho_b", faixa + faixa).fetchall()
+
+    def fechar(self):
+        """Fecha a conexão com o índice."""
+        with self._trava:
+            self._conexao.close()
+
+
+def _listar_pasta(pasta: str, mtime_conhecido: int, subpastas_conhecidas: list) -> tuple:
+    """Visita uma pasta da varredura: (mtime, arquivos, subpastas).
+
+    Se o mtime bate com o checkpoint, nada mudou diretamente nela: os
+    arquivos vêm como None e as subpastas saem do índice, sem listar.
+    mtime None indica que a pasta sumiu.
+    """
+    try:
+        mtime = os.stat(pasta).st_mtime_ns
+    except FileNotFoundError:
+        return None, None, []
+    if mtime == mtime_conhecido:
+        return mtime, None, subpastas_conhecidas
+    arquivos, subpastas = [], []
+    with os.scandir(pasta) as entradas:
+        for entrada in entradas:
+            # Pula ocultas (inclusive PASTA_TEMPORARIA e parciais)
+            if entrada.name.startswith("."):
+                continue
+            if entrada.is_dir(follow_symlinks=False):
+                subpastas.append(entrada.path)
+            elif os.path.splitext(entrada.name)[1].lower() in EXTENSOES_AUDIO and entrada.is_file():
+                info = entrada.stat()
+                arquivos.append((entrada.path, info.st_size, info.st_mtime_ns))
+    return mtime, arquivos, subpastas
+
+
+def varrer_pasta(biblioteca: Biblioteca, raiz: str, threads: int = 8) -> dict:
+    """Varredura incremental de uma pasta de músicas para o índice.
+
+    Usa `os.scandir` em várias pastas ao mesmo tempo e um checkpoint de
+    mtime por pasta: numa nova varredura só são listadas as pastas cujo
+    conteúdo direto mudou; as demais custam um stat. Retorna contadores.
+    """
+    raiz = os.path.abspath(raiz)
+    conhecidas = biblioteca.pastas(raiz)
+    filhas = {}
+    for pasta, (pai, _) in conhecidas.items():
+        filhas.setdefault(pai, []).append(pasta)
+    contagem = {"pastas": 0, "listadas": 0, "arquivos": 0}
+
+    with ThreadPoolExecutor(max(1, threads), thread_name_prefix="varredura") as executor:
+        def visitar(pasta, pai):
+            mtime = conhecidas.get(pasta, (None, None))[1]
+            futuro = executor.submit(_listar_pasta, pasta, mtime, filhas.get(pasta, []))
+            pendentes[futuro] = (pasta, pai)
+
+        pendentes = {}
+        visitar(raiz, None)
+        while pendentes:
+            feitos, _ = concurrent.futures.wait(pendentes, return_when=concurrent.futures.FIRST_COMPLETED)
+            for futuro in feitos:
+                pasta, pai = pendentes.pop(futuro)
+                try:
+                    mtime, arquivos, subpastas = futuro.result()
+                except OSError:
+                    continue
+                if mtime is None:
+                    biblioteca.esquecer_pasta(pasta)
+                    continue
+                contagem["pastas"] += 1
+                if arquivos is not None:
+                    contagem["listadas"] += 1
+                    contagem["arquivos"] += len(arquivos)
+                    for sumida in set(filhas.get(pasta, [])) - set(subpastas):
+                        biblioteca.esquecer_pasta(sumida)
+                    biblioteca.gravar_pasta(raiz, pasta, pai, mtime, arquivos)
+                for subpasta in subpastas:
+                    visitar(subpasta, pasta)
+    return contagem
+
+
+def _normalizar(texto: str) -> str:
+    """Forma comparável de título/artista: sem acentos, caixa, pontuação
+    nem complementos como "(Remastered)", "- Live" ou "feat. X"."""
+    texto = unicodedata.normalize("NFKD", texto or "").encode("ascii", "ignore").decode().lower()
+    texto = re.sub(r"[(\[].*?[)\]]|\s-\s.*$|\s(feat|ft)\..*$", "", texto)
+    return " ".join(re.findall(r"[a-z0-9]+", texto))
+
+
+def _hash_arquivo(caminho: str) -> str:
+    """sha1 do conteúdo lendo via mmap (sem copiar para buffers do Python)."""
+    with open(caminho, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return hashlib.sha1().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapa:
+            return hashlib.sha1(mapa).hexdigest()
+
+
+def _ler_tags(caminho: str) -> dict:
+    """Tags, duração, hash e (se o spotdl gravou) id do Spotify de um arquivo.
+
+    Usa o mutagen, que vem com o spotdl; sem ele, só o hash é lido.
+    """
+    dados = {"caminho": caminho, "hash": _hash_arquivo(caminho)}
+    try:
+        import mutagen
+        arquivo = mutagen.File(caminho)
+        simples = mutagen.File(caminho, easy=True)
+    except Exception:
+        return dados
+    if arquivo is None:
+        return dados
+    # O spotdl grava a URL da faixa nas tags; é a identificação mais segura
+    brutas = " ".join(str(v) for v in (arquivo.tags or {}).values())
+    encontrada = re.search(r"open\.spotify\.com/track/([A-Za-z0-9]{22})", brutas)
+    primeira = lambda chave: ((simples.tags or {}).get(chave) or [None])[0] if simples else None
+    dados.update(
+        song_id=encontrada.group(1) if encontrada else None,
+        titulo=primeira("title"),
+        artistas=", ".join((simples.tags or {}).get("artist", [])) if simples else None,
+        album=primeira("album"),
+        isrc=primeira("isrc"),
+        duracao=getattr(arquivo.info, "length", None),
+    )
+    return dados
+
+
+def _ler_tags_lote(caminhos: list) -> list:
+    """`_ler_tags` para um lote (uma ida e volta por lote no pool de processos)."""
+    lidos = []
+    for caminho in caminhos:
+        try:
+            lidos.append(_ler_tags(caminho))
+        except OSError:
+            pass
+    return lidos
+
+
+@lru_cache(maxsize=None)
+def _grafo_impressao() -> str:
+    """Filtro do ffmpeg que entrega a energia por banda, QUADROS_POR_S vezes por segundo.
+
+    Cada banda é um passa-faixa seguido de quadrado e reamostragem (que já
+    filtra e decima); todo o processamento pesado fica dentro do ffmpeg.
+    """
+    n = BANDAS_IMPRESSAO
+    bordas = [300 * (2000 / 300) ** (i / n) for i in range(n + 1)]
+    ramos = "".join(
+        f"[b{i}]bandpass=f={(bordas[i] * bordas[i + 1]) ** 0.5:.0f}:width_type=h:"
+        f"w={bordas[i + 1] - bordas[i]:.0f},aeval=val(0)*val(0),aresample={QUADROS_POR_S},"
+        f"aformat=sample_fmts=flt:channel_layouts=mono[e{i}];"
+        for i in range(n))
+    return (f"[0:a]aformat=channel_layouts=mono,aresample=5512,asplit={n}"
+            + "".join(f"[b{i}]" for i in range(n)) + ";" + ramos
+            + "".join(f"[e{i}]" for i in range(n)) + f"amerge=inputs={n}[saida]")
+
+
+def impressao_digital(ffmpeg: str, caminho: str) -> array.array:
+    """Impressão digital acústica: uma palavra de 16 bits por quadro.
+
+    Cada bit diz se a diferença de energia entre duas bandas vizinhas
+    subiu ou desceu em relação ao quadro anterior, o que sobrevive a
+    reencodes, mudança de volume e de formato.
+    """
+    resultado = subprocess.run(
+        [ffmpeg, "-v", "error", "-t", str(DURACAO_IMPRESSAO_S), "-i", caminho,
+         "-filter_complex", _grafo_impressao(), "-map", "[saida]", "-f", "f32le", "-"],
+        capture_output=True, creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+    if resultado.returncode != 0:
+        raise RuntimeError(resultado.stderr.decode("utf-8", "replace").strip()[-200:])
+    n = BANDAS_IMPRESSAO
+    energias = array.array("f")
+    energias.frombytes(resultado.stdout[:len(resultado.stdout) // (4 * n) * 4 * n])
+    impressao = array.array("H")
+    anterior = None
+    for inicio in range(0, len(energias), n):
+        quadro = energias[inicio:inicio + n]
+        diferencas = [quadro[m] - quadro[m + 1] for m in range(n - 1)]
+        if anterior is not None:
+            impressao.append(sum(1 << m for m in range(n - 1) if diferencas[m] > anterior[m]))
+        anterior = diferencas
+    return impressao
+
+
+def _chaves_impressao(impressao: array.array) -> list:
+    """(chave, quadro): pares de palavras vizinhas, amostrados pelo conteúdo.
+
+    Cada chave junta duas palavras seguidas em 32 bits, específica o
+    bastante para o índice devolver só candidatas reais (palavras de 16
+    bits se repetem entre milhares de músicas). Fica 1 chave a cada
+    `AMOSTRA_CHAVES`, escolhida por um hash da própria chave, então a mesma gravação com
+    outro início (intro cortada, silêncio a mais) gera as mesmas chaves.
+    """
+    chaves = []
+    for quadro in range(len(impressao) - 1):
+        if impressao[quadro] and impressao[quadro + 1]:
+            chave = impressao[quadro] << 16 | impressao[quadro + 1]
+            if ((chave * 0x9E3779B1) >> 24 & 0xFF) % AMOSTRA_CHAVES == 0:
+                chaves.append((chave, quadro))
+    return chaves
+
+
+def _distancia_impressoes(a: array.array, b: array.array, deslocamento: int) -> float:
+    """Fração de bits diferentes com `b` deslocada; 1.0 se mal se sobrepõem."""
+    melhor = 1.0
+    for ajuste in (-1, 0, 1):
+        d = deslocamento + ajuste
+        pares = list(zip(a[max(0, -d):], b[max(0, d):]))
+        if len(pares) < 5 * QUADROS_POR_S:
+            continue
+        bits = sum(bin(x ^ y).count("1") for x, y in pares)
+        melhor = min(melhor, bits / (16 * len(pares)))
+    return melhor
+
+
+def _cabecalho_valido(cabeca: bytes, extensao: str) -> bool:
+    """Confere a assinatura do contêiner nos primeiros 12 bytes."""
+    if extensao == ".mp3":
+        # Tag ID3 ou sincronismo de quadro MPEG (11 bits em 1)
+        return cabeca[:3] == b"ID3" or (len(cabeca) > 1 and cabeca[0] == 0xFF
+                                        and cabeca[1] & 0xE0 == 0xE0)
+    if extensao == ".m4a":
+        return cabeca[4:8] == b"ftyp"
+    assinaturas = {".opus": b"OggS", ".ogg": b"OggS", ".flac": b"fLaC", ".wav": b"RIFF"}
+    return extensao not in assinaturas or cabeca.startswith(assinaturas[extensao])
+
+
+def verificar_arquivo(caminho: str, ffmpeg: str, duracao: float, tamanho_minimo: int,
+                      decodificar: bool) -> str:
+    """Verifica uma música pronta; retorna o problema encontrado ou "".
+
+    Cabeçalho e tamanho são conferidos sempre (12 bytes lidos). A
+    decodificação completa pelo ffmpeg só roda se `decodificar` (amostra)
+    ou se o tamanho for suspeito, e pega erros de decodificação e
+    arquivos bem mais curtos que a música.
+    """
+    try:
+        tamanho = os.path.getsize(caminho)
+        with open(caminho, "rb") as f:
+            cabeca = f.read(12)
+    except OSError as e:
+        return str(e)
+    if not _cabecalho_valido(cabeca, os.path.splitext(caminho)[1].lower()):
+        return "cabeçalho do contêiner inválido"
+    if not decodificar and tamanho >= tamanho_minimo:
+        return ""
+
+    try:
+        resultado = subprocess.run(
+            [ffmpeg, "-v", "error", "-nostdin", "-nostats", "-progress", "pipe:1",
+             "-i", caminho, "-f", "null", "-"],
+            capture_output=True, creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+    except OSError:
+        # Sem ffmpeg para decodificar, fica o que as checagens baratas viram
+        return ""
+    erros = resultado.stderr.decode("utf-8", "replace").strip()
+    if resultado.returncode != 0 or erros:
+        return f"falha ao decodificar ({erros.splitlines()[-1] if erros else resultado.returncode})"
+    tempos = re.findall(rb"out_time_us=(\d+)", resultado.stdout)
+    decodificado = int(tempos[-1]) / 1e6 if tempos else 0
+    if duracao and decodificado < 0.8 * duracao:
+        return f"truncado ({decodificado:.0f}s de {duracao:.0f}s)"
+    return ""
+
+
+class EnviosDestino:
+    """Estágio de write-behind: leva arquivos prontos do rascunho ao destino.
+
+    Roda em threads próprias, com concorrência e novas tentativas
+    independentes dos workers; um destino lento (pendrive, compartilhamento
+    de rede) deixa de segurar download e conversão.
+    """
+
+    def __init__(self, simultaneos: int, tentativas: int):
+        self.tentativas = max(1, tentativas)
+        self._executor = ThreadPoolExecutor(max(1, simultaneos), thread_name_prefix="envio")
+
+    async def enviar(self, origem: str, destino: str) -> Path:
+        """Publica `origem` em `destino` (atômico), com backoff entre tentativas."""
+        loop = asyncio.get_running_loop()
+        for tentativa in range(1, self.tentativas + 1):
+            try:
+                return await loop.run_in_executor(
+                    self._executor, mover_atomico, Path(origem), Path(destino))
+            except OSError:
+                if tentativa == self.tentativas:
+                    raise
+                await asyncio.sleep(2 ** tentativa)
+
+    def encerrar(self):
+        """Espera os envios em curso terminarem."""
+        self._executor.shutdown(wait=True)
+
+
+class MotorDownloads:
+    """Motor de downloads sobre um event loop asyncio próprio.
+
+    Cada job é expandido em músicas por um worker e as músicas são
+    distribuídas entre os workers do pool. O progresso sai como eventos
+    estruturados (dicts) na fila `eventos`, que a interface consome no
+    loop do Tk; nenhuma chamada ao Tk é feita fora da thread principal.
+    """
+
+    def __init__(self, config: dict):
+        """Sobe o event loop numa thread dedicada."""
+        self.config = config
+        self.eventos = queue.Queue()
+        self.spotdl_cli = None
+        self.loop = asyncio.new_event_loop()
+        self.reservas = ReservasDisco(int(float(config["margem_disco_mb"]) * 2**20))
+        self.envios = EnviosDestino(int(config["envios_simultaneos"]),
+                                    int(config["tentativas_envio"]))
+        try:
+            self.biblioteca = Biblioteca(_pasta_dados() / "biblioteca.db")
+        except (OSError, sqlite3.Error) as e:
+            # Sem índice os downloads seguem; só a biblioteca fica desligada
+            self.biblioteca = None
+            self._emitir(None, "biblioteca", texto=(
+                f"⚠️ Índice da biblioteca indisponível ({e}); recursos da biblioteca desligados"))
+        verificacoes = int(config["verificacoes_simultaneas"])
+        self.verificacoes = ProcessPoolExecutor(verificacoes) if verificacoes > 0 else None
+        self.analises = (ProcessPoolExecutor(int(config["processos_loudness"]) or None)
+                         if config["replaygain"] else None)
+        self._tarefas = {}
+        self._jobs = {}
+        self._proximo_id = 0
+        thread = threading.Thread(target=self.loop.run_forever)
+        thread.daemon = True
+        thread.start()
+        self.pool, self.pool_prefetch, self.pool_expansao = self._executar(
+            self._criar_pools()).result()
+
+    async def _criar_pools(self) -> tuple:
+        """Cria os pools dentro do loop (primitivas asyncio ficam presas a ele).
+
+        O pool de prefetch só resolve metadados e fontes das próximas
+        músicas, e o de expansão só pagina álbuns e playlists; ficam
+        separados para nunca disputar vaga com os downloads.
+        """
+        prefetch = int(self.config["workers_prefetch"])
+        return (PoolWorkers(self.config),
+                PoolWorkers(self.config, prefetch) if prefetch > 0 else None,
+                PoolWorkers(self.config, 1))
+
+    def _executar(self, corotina):
+        """Agenda uma corrotina no loop do motor a partir de outra thread."""
+        return asyncio.run_coroutine_threadsafe(corotina, self.loop)
+
+    def _emitir(self, job: int, tipo: str, **dados):
+        """Publica um evento para a interface."""
+        self.eventos.put(dict(dados, job=job, tipo=tipo))
+
+    def aquecer(self):
+        """Pré-inicia um worker em segundo plano."""
+        self._executar(self.pool.aquecer())
+        if self.pool_prefetch:
+            self._executar(self.pool_prefetch.aquecer())
+
+    def enviar(self, url: str, pasta: str, perfil: dict, ffmpeg: str = None) -> int:
+        """Enfileira um job e retorna seu id."""
+        self._tarefas = {k: t for k, t in self._tarefas.items() if not t.done()}
+        self._jobs = {k: j for k, j in self._jobs.items() if k in self._tarefas}
+        self._proximo_id += 1
+        job = {
+            "id": self._proximo_id,
+            "url": url,
+            "pasta": pasta,
+            "perfil": perfil,
+            "em_andamento": {},
+            "encerramentos": [],
+            "liberado": asyncio.Event(),
+            "opcoes": {
+                "segmentos": int(self.config["segmentos_por_download"]),
+                "segmento_min_mb": float(self.config["segmento_min_mb"]),
+                "temporarios": pasta,
+                "organizacao": self.config["organizacao"],
+                "aparar_silencio": bool(perfil.get("aparar_silencio")),
+                "encoder": perfil.get("encoder") or perfil["encoders"][-1],
+                "capa_px": int(self.config["tamanho_capa"]),
+                "capas_mb": float(self.config["cache_capas_mb"]),
+            },
+            "drenando": False,
+            "refeitas": {},
+            "medicoes": {},
+            "total": 0,
+            "excedentes": 0,
+            "config": {
+                "output": str(Path(pasta) / ORGANIZACOES.get(self.config["organizacao"],
+                                                             self.config["organizacao"])),
+                "format": perfil["formato"],
+                "bitrate": perfil["bitrate"],
+                "ffmpeg": ffmpeg or "ffmpeg",
+                "ffmpeg_args": ffmpeg_args_perfil(perfil),
+            },
+        }
+        job["liberado"].set()
+        self._jobs[job["id"]] = job
+        self._tarefas[job["id"]] = self._executar(self._executar_job(job))
+        return job["id"]
+
+    def cancelar(self, job_id: int):
+        """Cancela um job em andamento."""
+        tarefa = self._tarefas.get(job_id)
+        if tarefa:
+            tarefa.cancel()
+
+    def pausar(self, job_id: int):
+        """Congela o despacho de músicas (as em andamento terminam)."""
+        self._controlar(job_id, lambda job: job["liberado"].clear())
+
+    def retomar(self, job_id: int):
+        """Volta a despachar músicas de um job pausado."""
+        self._controlar(job_id, lambda job: job["liberado"].set())
+
+    def drenar(self, job_id: int):
+        """Termina as músicas em andamento e encerra o job sem iniciar novas."""
+        def drenar_job(job):
+            job["drenando"] = True
+            job["liberado"].set()
+            if job.get("entrada"):
+                # Acorda produtores parados à espera da próxima página
+                job["entrada"].put_nowait((None, None))
+        self._controlar(job_id, drenar_job)
+
+    def _controlar(self, job_id: int, acao):
+        """Aplica `acao(job)` dentro do loop do motor."""
+        job = self._jobs.get(job_id)
+        if job:
+            self.loop.call_soon_threadsafe(acao, job)
+
+    def indexar(self, pasta: str):
+        """Atualiza o índice da biblioteca com o conteúdo de `pasta`.
+
+        Eventos de biblioteca saem com job None e tipo "biblioteca"; o
+        último traz fim=True.
+        """
+        if self._biblioteca_disponivel():
+            self._executar(self._indexar(pasta))
+
+    async def _indexar(self, pasta: str):
+        """Roda a varredura incremental fora do loop e relata o resultado."""
+        self._emitir(None, "biblioteca", texto=f"🔎 Indexando {pasta}...")
+        inicio = time.monotonic()
+        try:
+            contagem = await asyncio.get_running_loop().run_in_executor(
+                None, varrer_pasta, self.biblioteca, pasta, int(self.config["threads_varredura"]))
+        except (OSError, sqlite3.Error) as e:
+            self._emitir(None, "biblioteca", texto=f"❌ Falha ao indexar {pasta}: {e}", fim=True)
+            return
+        self._emitir(None, "biblioteca", fim=True, texto=(
+            f"📚 {contagem['pastas']} pasta(s) verificada(s), {contagem['listadas']} "
+            f"relida(s), {contagem['arquivos']} arquivo(s) atualizados em "
+            f"{time.monotonic() - inicio:.1f}s"))
+
+    def adotar(self, pasta: str):
+        """Incorpora ao índice uma biblioteca já existente em `pasta`.
+
+        As músicas identificadas no Spotify nunca mais são baixadas.
+        Eventos como em `indexar`.
+        """
+        if self._biblioteca_disponivel():
+            self._executar(self._adotar(pasta))
+
+    async def _adotar(self, pasta: str):
+        """Varre, lê tags e hashes num pool de processos e identifica as faixas."""
+        loop = asyncio.get_running_loop()
+        self._emitir(None, "biblioteca", texto=f"📥 Adotando biblioteca em {pasta}...")
+        identificadas = 0
+        try:
+            await loop.run_in_executor(None, varrer_pasta, self.biblioteca, pasta,
+                                       int(self.config["threads_varredura"]))
+            pendentes = self.biblioteca.pendentes_adocao(pasta)
+            conhecidos = {caminho: song_id for caminho, song_id in pendentes}
+            caminhos = list(conhecidos)
+            self._emitir(None, "biblioteca", texto=f"🏷️ Lendo tags de {len(caminhos)} arquivo(s)...")
+
+            lidos = []
+            processos = int(self.config["processos_biblioteca"]) or None
+            with ProcessPoolExecutor(processos) as executor:
+                lotes = [loop.run_in_executor(executor, _ler_tags_lote, caminhos[i:i + 64])
+                         for i in range(0, len(caminhos), 64)]
+                for lote in asyncio.as_completed(lotes):
+                    lidos += await lote
+
+            # Já identificados (baixados pelo BaixaFy ou com a URL nas tags)
+            # não precisam de busca
+            buscar, prontos = [], []
+            for dados in lidos:
+                song_id = conhecidos[dados["caminho"]] or dados.get("song_id")
+                if song_id:
+                    prontos.append((dados, {"song_id": song_id}))
+                    identificadas += 1
+                elif dados.get("isrc") or dados.get("titulo"):
+                    buscar.append(dados)
+                else:
+                    prontos.append((dados, None))
+            # Em lotes fora do loop: a trava do índice nunca fica presa
+            # tempo bastante para atrasar as músicas dos jobs em andamento
+            for i in range(0, len(prontos), 1000):
+                await loop.run_in_executor(None, self.biblioteca.identificar, prontos[i:i + 1000])
+
+            if buscar:
+                self._emitir(None, "biblioteca",
+                             texto=f"🔎 Procurando {len(buscar)} faixa(s) no Spotify...")
+                for i in range(0, len(buscar), 50):
+                    lote = buscar[i:i + 50]
+                    # O worker volta ao pool a cada lote: a expansão de um
+                    # job iniciado no meio da adoção não espera a busca toda
+                    worker = await self.pool_expansao.obter()
+                    if worker is None:
+                        raise RuntimeError("spotdl indisponível para identificar as faixas")
+                    try:
+                        fim = await worker.comando(
+                            {"cmd": "identificar", "id": None, "config": {}, "tags": lote},
+                            lambda evento: None)
+                    finally:
+                        self.pool_expansao.devolver(worker)
+                    musicas = fim.get("musicas") or [None] * len(lote)
+                    await loop.run_in_executor(
+                        None, self.biblioteca.identificar, list(zip(lote, musicas)))
+                    identificadas += sum(map(bool, musicas))
+        except Exception as e:
+            self._emitir(None, "biblioteca", texto=f"❌ Falha ao adotar {pasta}: {e}", fim=True)
+            return
+        self._emitir(None, "biblioteca", fim=True, texto=(
+            f"📚 {len(lidos)} arquivo(s) lido(s), {identificadas} identificado(s); "
+            f"essas músicas não serão baixadas de novo"))
+
+    def deduplicar(self, pasta: str, ffmpeg: str = None):
+        """Procura gravações repetidas em `pasta` pela impressão digital acústica.
+
+        Eventos como em `indexar`.
+        """
+        if self._biblioteca_disponivel():
+            self._executar(self._deduplicar(pasta, ffmpeg or "ffmpeg"))
+
+    def _biblioteca_disponivel(self) -> bool:
+        """False (e avisa o fim da tarefa) se o índice não pôde ser aberto."""
+        if self.biblioteca is None:
+            self._emitir(None, "biblioteca", texto="❌ Índice da biblioteca indisponível", fim=True)
+        return self.biblioteca is not None
+
+    async def _deduplicar(self, pasta: str, ffmpeg: str):
+        """Calcula as impressões que faltam e compara cada nova pelo índice de chaves.
+
+        Só arquivos novos ou alterados são decodificados; cada impressão
+        nova é comparada apenas com as que compartilham chaves com ela no
+        mesmo deslocamento, nunca com a biblioteca inteira.
+        """
+        loop = asyncio.get_running_loop()
+        self._emitir(None, "biblioteca", texto=f"👯 Procurando duplicatas em {pasta}...")
+        novas = 0
+        try:
+            await loop.run_in_executor(None, varrer_pasta, self.biblioteca, pasta,
+                                       int(self.config["threads_varredura"]))
+            self.biblioteca.podar_impressoes()
+            pendentes = self.biblioteca.sem_impressao(pasta)
+            if pendentes:
+                self._emitir(None, "biblioteca",
+                             texto=f"🎼 Calculando {len(pendentes)} impressão(ões) digital(is)...")
+            # O trabalho pesado é do ffmpeg; threads bastam para paralelizar
+            threads = int(self.config["processos_biblioteca"]) or os.cpu_count() or 1
+            with ThreadPoolExecutor(threads, thread_name_prefix="impressao") as executor:
+                async def calcular(caminho, mtime):
+                    try:
+                        return caminho, mtime, await loop.run_in_executor(
+                            executor, impressao_digital, ffmpeg, caminho)
+                    except RuntimeError:
+                        # Arquivo que o ffmpeg não decodifica fica sem impressão
+                        return caminho, mtime, None
+
+                for tarefa in asyncio.as_completed([calcular(*p) for p in pendentes]):
+                    caminho, mtime, impressao = await tarefa
+                    if impressao:
+                        # SQLite e comparação fora do loop: jobs seguem rodando
+                        await loop.run_in_executor(
+                            None, self._comparar_impressao, caminho, mtime, impressao)
+                        novas += 1
+        except Exception as e:
+            self._emitir(None, "biblioteca", texto=f"❌ Falha ao procurar duplicatas: {e}", fim=True)
+            return
+
+        # Pares baratos (id, ISRC, hash, tags) já vêm do índice, atualizado a
+        # cada música concluída; a impressão pega o que eles não pegam
+        pares = {}
+        for caminho_a, caminho_b, metodo, distancia in self.biblioteca.duplicatas(pasta):
+            motivo = f"áudio {distancia:.0%} diferente" if metodo == "impressao" else metodo
+            pares.setdefault((caminho_a, caminho_b), []).append(motivo)
+        for (caminho_a, caminho_b), motivos in list(pares.items())[:50]:
+            self._emitir(None, "biblioteca", texto=(
+                f"👯 {os.path.basename(caminho_a)} ≈ {os.path.basename(caminho_b)} "
+                f"({', '.join(motivos)})"))
+        self._emitir(None, "biblioteca", fim=True, texto=(
+            f"📚 {novas} impressão(ões) nova(s); {len(pares)} par(es) de duplicatas"))
+
+    def _comparar_impressao(self, caminho: str, mtime: int, impressao: array.array):
+        """Grava a impressão e registra as gravações iguais já indexadas."""
+        chaves = _chaves_impressao(impressao)
+        id_ = self.biblioteca.gravar_impressao(caminho, mtime, impressao, chaves)
+        for outra, votos in self.biblioteca.votar_impressao(id_, chaves).items():
+            deslocamento, quantidade = votos.most_common(1)[0]
+            if quantidade < VOTOS_IMPRESSAO:
+                continue
+            caminho_outra, impressao_outra = self.biblioteca.impressao(outra)
+            distancia = _distancia_impressoes(impressao, impressao_outra, deslocamento)
+            if distancia < LIMIAR_IMPRESSAO:
+                self.biblioteca.registrar_duplicata(caminho, caminho_outra, "impressao", distancia)
+
+    def encerrar(self):
+        """Cancela os jobs, encerra workers e o event loop."""
+        for tarefa in self._tarefas.values():
+            tarefa.cancel()
+        try:
+            self._executar(self._aguardar_jobs()).result(timeout=30)
+            self._executar(self.pool.encerrar()).result(timeout=10)
+            if self.pool_prefetch:
+                self._executar(self.pool_prefetch.encerrar()).result(timeout=10)
+            self._executar(self.pool_expansao.encerrar()).result(timeout=10)
+        except Exception:
+            pass
+        self.envios.encerrar()
+        for executor in (self.verificacoes, self.analises):
+            if executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+        if self.biblioteca:
+            self.biblioteca.fechar()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _aguardar_jobs(self):
+        """Espera as tarefas de job terminarem (inclusive a limpeza)."""
+        tarefas = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        await asyncio.gather(*tarefas, return_exceptions=True)
+
+    async def _executar_job(self, job: dict):
+        """Expande o job em streaming e baixa as músicas em paralelo nos workers."""
+        expansao = None
+        try:
+            # Sem spotdl importável no worker, cai para o spotdl de linha de comando
+            worker = await self.pool.obter()
+            if worker is None:
+                codigo, erro = await self._executar_cli(job)
+                self._emitir(job["id"], "job_fim", codigo=codigo, erro=erro, pasta=job["pasta"])
+                return
+            self.pool.devolver(worker)
+            Path(job["pasta"]).mkdir(parents=True, exist_ok=True)
+            self._preparar_rascunho(job)
+            _limpar_temporarios(job["opcoes"]["temporarios"])
+
+            # Checkpoint: músicas concluídas numa execução anterior são puladas
+            job["concluidas"] = self._ler_checkpoint(job)
+
+            entrada = job["entrada"] = asyncio.Queue()
+            expansao = asyncio.ensure_future(self._expandir(job, entrada))
+            resultados = list((await self._despachar(job, entrada)).values())
+            if job["drenando"] and not expansao.done():
+                expansao.cancel()
+            fim = (await asyncio.gather(expansao, return_exceptions=True))[0]
+            await self._aplicar_ganhos(job)
+            if isinstance(fim, asyncio.CancelledError):
+                fim = {"codigo": FIM_INTERROMPIDO}
+            elif isinstance(fim, BaseException):
+                fim = {"codigo": 1, "erro": str(fim)}
+
+            falhas = resultados.count(False)
+            pendentes = job["total"] + job["excedentes"] - resultados.count(True) - falhas
+            if pendentes or fim["codigo"] == FIM_INTERROMPIDO:
+                self._emitir(job["id"], "job_fim", codigo=FIM_INTERROMPIDO, pasta=job["pasta"],
+                             erro=f"{pendentes} música(s) ficaram para depois")
+                return
+            if fim["codigo"] != 0:
+                self._emitir(job["id"], "job_fim", codigo=fim["codigo"], erro=fim["erro"], pasta=job["pasta"])
+                return
+            if not falhas:
+                self._apagar_checkpoint(job)
+            self._emitir(job["id"], "job_fim", codigo=1 if falhas else 0,
+                         erro=f"{falhas} de {job['total']} música(s) falharam" if falhas else "",
+                         pasta=job["pasta"])
+        except asyncio.CancelledError:
+            if expansao:
+                expansao.cancel()
+                await asyncio.gather(expansao, return_exceptions=True)
+            await self._limpar_cancelamento(job)
+            self._emitir(job["id"], "job_fim", codigo=FIM_CANCELADO, erro="Cancelado", pasta=job["pasta"])
+            raise
+        except Exception as e:
+            # Sem job_fim a interface ficaria presa em "Baixando..."
+            if expansao:
+                expansao.cancel()
+                await asyncio.gather(expansao, return_exceptions=True)
+            await self._limpar_cancelamento(job)
+            self._emitir(job["id"], "job_fim", codigo=1, erro=str(e), pasta=job["pasta"])
+        finally:
+            for _, medicao in job["medicoes"].values():
+                medicao.cancel()
+            self.reservas.liberar(job["id"])
+
+    async def _expandir(self, job: dict, entrada: asyncio.Queue) -> dict:
+        """Alimenta `entrada` com as músicas do job conforme as páginas chegam.
+
+        Links de música entram direto, sem worker; álbuns e playlists são
+        paginados pelo pool de expansão, e cada página já vai para a fila
+        enquanto as seguintes ainda estão sendo buscadas. Termina colocando
+        o marcador (None, None) na fila e retorna o evento de fim.
+        """
+        puladas = repetidas = 0
+        vistas = set()
+
+        def enfileirar(musicas: list, total: int):
+            nonlocal puladas, repetidas
+            novas = []
+            for musica in musicas:
+                # A mesma música duas vezes na playlist daria o mesmo
+                # temporário e o mesmo destino em dois workers ao mesmo tempo
+                if _id_musica(musica) in vistas:
+                    repetidas += 1
+                    continue
+                vistas.add(_id_musica(musica))
+                concluida = _id_musica(musica) in job["concluidas"]
+                existente = None
+                if self.biblioteca and (not concluida or self.analises):
+                    existente = self.biblioteca.possui(musica, job["pasta"], job["perfil"]["formato"])
+                if not concluida and not existente:
+                    novas.append(musica)
+                elif existente and self.analises:
+                    # Já no disco: entra no ganho de álbum (e é medida se
+                    # uma execução anterior parou antes disso)
+                    self._agendar_medicao(job, musica, existente)
+            puladas += len(musicas) - len(novas)
+            if job["total"] == 0 and novas:
+                self._preverificar_espaco(job, novas, total - puladas)
+            dividir = self.config["espaco_insuficiente"] == "dividir"
+            for musica in novas:
+                if dividir and job["excedentes"]:
+                    job["excedentes"] += 1
+                    continue
+                tamanho = estimar_tamanho(musica.get("duration"), job["perfil"])
+                if not self.reservas.reservar(job["pasta"], job["id"], job["total"], tamanho) and dividir:
+                    # Sem espaço: desta música em diante, tudo fica para outra execução
+                    job["excedentes"] += 1
+                    continue
+                entrada.put_nowait((job["total"], musica))
+                job["total"] += 1
+            if not job["excedentes"]:
+                total = max(total - puladas, job["total"])
+            self._emitir(job["id"], "expandido", total=job["total"] if job["excedentes"] else total)
+
+        def ao_evento(evento: dict):
+            if evento["tipo"] == "faixas":
+                # Pertencimento à playlist/álbum alimenta a busca da biblioteca
+                if self.biblioteca:
+                    self.biblioteca.registrar_playlist(
+                        job["url"], job.get("colecao"), [_id_musica(m) for m in evento["musicas"]])
+                enfileirar(evento["musicas"], evento["total"])
+            elif evento["tipo"] == "colecao":
+                job["colecao"] = evento["nome"]
+            else:
+                self._repassar(job["id"], evento)
+
+        try:
+            if "/track/" in job["url"]:
+                song_id = job["url"].split("/track/")[1].split("?")[0]
+                enfileirar([{"parcial": True, "url": job["url"], "song_id": song_id}], 1)
+                return {"codigo": 0}
+
+            worker = await self.pool_expansao.obter()
+            if worker is None:
+                return {"codigo": 1, "erro": "spotdl indisponível"}
+            try:
+                return await worker.comando(
+                    {"cmd": "expandir", "id": job["id"], "url": job["url"], "config": job["config"]},
+                    ao_evento)
+            finally:
+                if worker.encerramento:
+                    job["encerramentos"].append(worker.encerramento)
+                self.pool_expansao.devolver(worker)
+        finally:
+            if puladas > repetidas:
+                self._emitir(job["id"], "log", texto=f"♻️ {puladas - repetidas} música(s) já na "
+                             f"biblioteca ou concluída(s) antes, puladas")
+            if repetidas:
+                self._emitir(job["id"], "log",
+                             texto=f"🔁 {repetidas} música(s) repetida(s) no link, baixada(s) uma vez")
+            entrada.put_nowait((None, None))
+
+    def _preverificar_espaco(self, job: dict, amostra: list, total: int):
+        """Compara o tamanho estimado do job com o espaço livre no destino.
+
+        Usa a duração média da primeira página como estimativa para as
+        músicas ainda não paginadas. Só avisa: quem decide se o job é
+        dividido é a reserva feita música a música em `_expandir`.
+        """
+        media = sum(estimar_tamanho(m.get("duration"), job["perfil"]) for m in amostra) / len(amostra)
+        estimado = int(media * total)
+        livre = self.reservas.livre(job["pasta"])
+        self._emitir(job["id"], "log", texto=f"💾 Estimativa: {estimado / 2**30:.2f} GB "
+                     f"para {total} música(s); livre: {max(livre, 0) / 2**30:.2f} GB")
+        if estimado > livre:
+            if self.config["espaco_insuficiente"] == "dividir":
+                texto = "Espaço insuficiente: só as músicas que couberem serão baixadas agora"
+            else:
+                texto = "Espaço em disco pode acabar antes do fim do job"
+            self._emitir(job["id"], "aviso", texto=texto)
+
+    def _arquivo_checkpoint(self, job: dict) -> Path:
+        """Checkpoint do job (mesma URL, pasta e formato): um id concluído por linha.
+
+        Só cresce por append, então registrar uma música custa uma linha,
+        não regravar a lista inteira.
+        """
+        chave = f"{job['url']}|{os.path.abspath(job['pasta'])}|{job['perfil']['formato']}"
+        return _pasta_dados() / "jobs" / f"{hashlib.sha1(chave.encode('utf-8')).hexdigest()}.log"
+
+    def _ler_checkpoint(self, job: dict) -> set:
+        """Ids concluídos em execuções anteriores (inclui o formato JSON antigo)."""
+        arquivo = self._arquivo_checkpoint(job)
+        concluidas = set(_ler_json(arquivo.with_suffix(".json")).get("concluidas", []))
+        try:
+            with open(arquivo, encoding="utf-8") as f:
+                # Linha cortada por uma queda não casa com nenhum id
+                concluidas.update(linha.strip() for linha in f if linha.strip())
+        except OSError:
+            pass
+        return concluidas
+
+    def _marcar_concluida(self, job: dict, musica: dict, arquivo: str):
+        """Registra a música no checkpoint e no índice assim que ela termina."""
+        try:
+            registradas = (self.biblioteca.registrar(job["pasta"], arquivo, musica)
+                           if self.biblioteca else [])
+            for outro, metodo in registradas:
+                self._emitir(job["id"], "log", texto=(
+                    f"👯 {_nome_musica(musica)} também está em {outro} ({metodo})"))
+        except (OSError, sqlite3.Error) as e:
+            self._emitir(job["id"], "log", texto=f"⚠️ Índice da biblioteca: {e}")
+        if self.analises:
+            self._agendar_medicao(job, musica, arquivo)
+        job["concluidas"].add(_id_musica(musica))
+        arquivo = self._arquivo_checkpoint(job)
+        try:
+            arquivo.parent.mkdir(exist_ok=True)
+            with open(arquivo, "a", encoding="utf-8") as f:
+                f.write(_id_musica(musica) + "\n")
+        except OSError:
+            pass
+
+    def _agendar_medicao(self, job: dict, musica: dict, arquivo: str):
+        """Mede a música em paralelo aos próximos downloads (uma vez por arquivo).
+
+        Arquivos de fora da pasta do job (adotados de outra biblioteca)
+        não são tocados.
+        """
+        arquivo = os.path.abspath(arquivo)
+        if arquivo in job["medicoes"] or not Path(arquivo).is_relative_to(
+                os.path.abspath(job["pasta"])):
+            return
+        job["medicoes"][arquivo] = (musica.get("duration") or 1,
+                                    asyncio.ensure_future(self._medir(job, arquivo)))
+
+    async def _medir(self, job: dict, arquivo: str):
+        """(lufs, pico) do arquivo: do índice ou medido no pool de análise.
+
+        Uma medição nova já sai com o ganho de faixa gravado no arquivo e
+        no índice, então um job cancelado ou que falhou não deixa sem
+        ReplayGain as músicas que terminaram. None se não deu para medir.
+        """
+        medida = self.biblioteca.loudness(arquivo) if self.biblioteca else None
+        if medida is not None:
+            return medida
+        loop = asyncio.get_running_loop()
+        try:
+            medida = await loop.run_in_executor(
+                self.analises, medir_loudness, job["config"]["ffmpeg"], arquivo)
+            if medida:
+                await loop.run_in_executor(self.analises, gravar_ganhos, arquivo, *medida)
+                if self.biblioteca:
+                    self.biblioteca.gravar_loudness(arquivo, *medida)
+        except Exception as e:
+            self._emitir(job["id"], "log", texto=f"⚠️ ReplayGain em {Path(arquivo).name}: {e}")
+            return None
+        return medida
+
+    async def _aplicar_ganhos(self, job: dict):
+        """Espera as medições do job e grava o ganho de álbum (jobs de álbum).
+
+        O ganho de faixa já sai em `_medir`. O de álbum vem da média de
+        energia de todas as faixas do álbum no disco (baixadas agora ou
+        puladas por já existirem, com a medição do índice), ponderada pela
+        duração; o pico do álbum é o maior pico. Ele é regravado em todas
+        as faixas, para o álbum inteiro ficar com o mesmo valor.
+        """
+        if not job["medicoes"]:
+            return
+        medidas = {}
+        for arquivo, (duracao, medicao) in job["medicoes"].items():
+            medida = await medicao
+            if medida:
+                medidas[arquivo] = (duracao, medida)
+        if "/album/" not in job["url"] or not medidas:
+            self._emitir(job["id"], "log", texto=f"🔊 ReplayGain em {len(medidas)} música(s)")
+            return
+        energia = sum(d * 10 ** (lufs / 10) for d, (lufs, _) in medidas.values())
+        duracao = sum(d for d, _ in medidas.values())
+        album = (10 * math.log10(energia / duracao) if energia else -70.0,
+                 max(pico for _, (_, pico) in medidas.values()))
+        loop = asyncio.get_running_loop()
+        gravadas = 0
+        for arquivo, (_, (lufs, pico)) in medidas.items():
+            try:
+                await loop.run_in_executor(self.analises, gravar_ganhos, arquivo, lufs, pico, album)
+                if self.biblioteca:
+                    self.biblioteca.gravar_loudness(arquivo, lufs, pico)
+                gravadas += 1
+            except Exception as e:
+                self._emitir(job["id"], "log", texto=f"⚠️ ReplayGain em {Path(arquivo).name}: {e}")
+        self._emitir(job["id"], "log", texto=(
+            f"🔊 ReplayGain gravado em {gravadas} música(s), ganho de álbum "
+            f"{REFERENCIA_REPLAYGAIN - album[0]:+.2f} dB"))
+
+    def _apagar_checkpoint(self, job: dict):
+        """Remove o checkpoint de um job concluído sem falhas."""
+        arquivo = self._arquivo_checkpoint(job)
+        for caminho in (arquivo, arquivo.with_suffix(".json")):
+            try:
+                os.remove(caminho)
+            except OSError:
+                pass
+
+    def _preparar_rascunho(self, job: dict):
+        """Aponta fontes e conversões do job para a pasta de rascunho.
+
+        Só arquivos prontos vão para o destino (em blocos grandes, via
+        `mover_atomico`); o I/O aleatório de download e encoder fica no
+        disco rápido. Sem rascunho utilizável, fica no volume de destino.
+        Com verificação ligada o envio é sempre do motor, para só arquivo
+        aprovado chegar ao destino (sem rascunho, um rename no volume).
+        """
+        if self.verificacoes:
+            job["opcoes"]["adiar_envio"] = True
+        rascunho = self.config.get("pasta_rascunho")
+        if not rascunho:
+            return
+        try:
+            Path(rascunho, "staging").mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            self._emitir(job["id"], "log",
+                         texto=f"⚠️ Pasta de rascunho indisponível ({e}); usando o destino")
+            return
+        job["opcoes"]["temporarios"] = rascunho
+        job["opcoes"]["staging"] = str(Path(rascunho, "staging"))
+        # A cópia para o destino sai do worker e vai para `self.envios`
+        job["opcoes"]["adiar_envio"] = True
+
+    async def _limpar_cancelamento(self, job: dict):
+        """Espera as árvores de processos morrerem e apaga arquivos parciais."""
+        await asyncio.gather(*job["encerramentos"], return_exceptions=True)
+        for arquivo in job["em_andamento"].values():
+            try:
+                os.remove(arquivo)
+                self._emitir(job["id"], "log", texto=f"🧹 Parcial removido: {arquivo}")
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self._emitir(job["id"], "log", texto=f"⚠️ Não foi possível remover {arquivo}: {e}")
+
+    async def _despachar(self, job: dict, entrada: asyncio.Queue) -> dict:
+        """Resolve as próximas músicas à frente e baixa conforme workers liberam.
+
+        Produtores (um por worker de prefetch) consomem a `entrada` da
+        expansão e resolvem metadados e fonte de até `prefetch` músicas à
+        frente numa fila limitada; consumidores (um por worker de download)
+        pegam da fila já prontas para baixar, sem pagar a busca no caminho
+        crítico. Retorna {índice: resultado}.
+        """
+        resultados = {}
+        fila = asyncio.Queue(maxsize=max(1, int(self.config["prefetch"])))
+        envios = {}
+
+        async def resolver():
+            while not job["drenando"]:
+                indice, musica = await entrada.get()
+                if musica is None:
+                    # Repassa o marcador de fim para os outros produtores
+                    entrada.put_nowait((None, None))
+                    return
+                musica = await self._resolver_musica(job, indice, musica)
+                if musica is None:
+                    resultados[indice] = False
+                else:
+                    await fila.put((indice, musica))
+
+        async def baixar():
+            while True:
+                indice, musica = await fila.get()
+                if musica is None:
+                    return
+                resultado = await self._baixar_musica(job, indice, musica)
+                if isinstance(resultado, asyncio.Future):
+                    # Envio ao destino segue em segundo plano; o worker já está livre
+                    envios[indice] = resultado
+                else:
+                    resultados[indice] = resultado
+
+        produtores = self.pool_prefetch.tamanho if self.pool_prefetch else 1
+        produtores = [asyncio.ensure_future(resolver()) for _ in range(produtores)]
+        consumidores = [asyncio.ensure_future(baixar()) for _ in range(self.pool.tamanho)]
+        try:
+            await asyncio.gather(*produtores)
+            for _ in consumidores:
+                await fila.put((None, None))
+            await asyncio.gather(*consumidores)
+            for indice, envio in envios.items():
+                resultados[indice] = await envio
+        finally:
+            for tarefa in produtores + consumidores + list(envios.values()):
+                tarefa.cancel()
+            await asyncio.gather(*produtores, *consumidores, *envios.values(),
+                                 return_exceptions=True)
+        return resultados
+
+    async def _resolver_musica(self, job: dict, indice: int, musica: dict):
+        """Resolve metadados e fonte de uma música no pool de prefetch.
+
+        Sem pool de prefetch a música segue como está e o worker de
+        download faz a busca. Retorna None (e emite a falha) se não houver
+        fonte para a música.
+        """
+        if self.pool_prefetch is None:
+            return musica
+        worker = await self.pool_prefetch.obter()
+        if worker is None:
+            return musica
+        try:
+            fim = await worker.comando(
+                {"cmd": "resolver", "id": job["id"], "musica": musica, "config": job["config"],
+                 "opcoes": job["opcoes"]},
+                lambda evento: self._repassar(job["id"], evento))
+        finally:
+            if worker.encerramento:
+                job["encerramentos"].append(worker.encerramento)
+            self.pool_prefetch.devolver(worker)
+
+        if fim["codigo"] != 0:
+            self.reservas.liberar(job["id"], indice)
+            self._emitir(job["id"], "musica_fim", indice=indice, nome=_nome_musica(musica),
+                         codigo=fim["codigo"], arquivo=None, erro=fim.get("erro", ""))
+            return None
+        return fim["musica"]
+
+    async def _baixar_musica(self, job: dict, indice: int, musica: dict):
+        """Baixa uma música no próximo worker livre.
+
+        Retorna True/False conforme o resultado, None se o job foi
+        drenado antes de a música começar, ou a tarefa de finalização
+        quando o arquivo pronto ainda precisa ser verificado ou ir do
+        rascunho para o destino.
+        """
+        while True:
+            await job["liberado"].wait()
+            if job["drenando"]:
+                return None
+            worker = await self.pool.obter()
+            if worker is None:
+                return False
+            if job["liberado"].is_set() and not job["drenando"]:
+                break
+            # Pausado (ou drenado) enquanto esperava um worker livre
+            self.pool.devolver(worker)
+
+        def ao_evento(evento):
+            if evento["tipo"] == "inicio" and not evento["existia"]:
+                job["em_andamento"][indice] = evento["arquivo"]
+            self._repassar(job["id"], evento, indice=indice, nome=_nome_musica(musica))
+
+        try:
+            fim = await worker.comando(
+                {"cmd": "baixar", "id": job["id"], "musica": musica, "config": job["config"],
+                 "opcoes": job["opcoes"]},
+                ao_evento)
+        finally:
+            if worker.encerramento:
+                job["encerramentos"].append(worker.encerramento)
+            self.pool.devolver(worker)
+
+        # Só o que o worker acabou de escrever passa pela verificação
+        novo = indice in job["em_andamento"]
+        if fim["codigo"] == 0 and (fim.get("envio") or (novo and self.verificacoes)):
+            return asyncio.ensure_future(self._finalizar_musica(job, indice, musica, fim))
+
+        self.reservas.liberar(job["id"], indice)
+        arquivo_parcial = job["em_andamento"].pop(indice, None)
+        if fim["codigo"] != 0 and arquivo_parcial:
+            # Saída truncada de uma música que falhou não pode ficar na pasta
+            try:
+                os.remove(arquivo_parcial)
+            except OSError:
+                pass
+
+        if fim["codigo"] == 0:
+            self._marcar_concluida(job, fim.get("musica") or musica, fim["arquivo"])
+        self._emitir(job["id"], "musica_fim", indice=indice, nome=_nome_musica(musica),
+                     codigo=fim["codigo"], arquivo=fim.get("arquivo"), erro=fim.get("erro", ""))
+        return fim["codigo"] == 0
+
+    async def _finalizar_musica(self, job: dict, indice: int, musica: dict, fim: dict):
+        """Verifica a música pronta, leva do rascunho ao destino e a conclui.
+
+        Roda fora do caminho do worker. Arquivo reprovado na verificação é
+        apagado e a música volta a ser baixada, até `tentativas_verificacao`
+        vezes; o resultado é o da última tentativa.
+        """
+        arquivo, codigo, erro = fim["arquivo"], 0, ""
+        problema = await self._verificar_musica(job, fim.get("musica") or musica, arquivo)
+        if problema:
+            job["em_andamento"].pop(indice, None)
+            try:
+                os.remove(arquivo)
+            except OSError:
+                pass
+            job["refeitas"][indice] = job["refeitas"].get(indice, 0) + 1
+            if job["refeitas"][indice] <= int(self.config["tentativas_verificacao"]):
+                self._emitir(job["id"], "log", texto=(
+                    f"🩺 {_nome_musica(musica)}: {problema}; baixando de novo"))
+                resultado = await self._baixar_musica(job, indice, musica)
+                return await resultado if isinstance(resultado, asyncio.Future) else resultado
+            arquivo, codigo, erro = None, 1, f"Arquivo corrompido: {problema}"
+        elif fim.get("envio"):
+            try:
+                arquivo = str(await self.envios.enviar(arquivo, fim["envio"]))
+            except OSError as e:
+                arquivo, codigo, erro = None, 1, f"Falha ao gravar no destino: {e}"
+                try:
+                    os.remove(fim["arquivo"])
+                except OSError:
+                    pass
+        self.reservas.liberar(job["id"], indice)
+        # Só sai de em_andamento aqui: um cancelamento no meio da
+        # verificação ou do envio ainda apaga o arquivo
+        job["em_andamento"].pop(indice, None)
+
+        if codigo == 0:
+            self._marcar_concluida(job, fim.get("musica") or musica, arquivo)
+        self._emitir(job["id"], "musica_fim", indice=indice, nome=_nome_musica(musica),
+                     codigo=codigo, arquivo=arquivo, erro=erro)
+        return codigo == 0
+
+    async def _verificar_musica(self, job: dict, musica: dict, arquivo: str) -> str:
+        """Roda `verificar_arquivo` no pool de processos; "" se aprovado."""
+        if not self.verificacoes:
+            return ""
+        duracao = musica.get("duration") or 0
+        # Metade do tamanho esperado só de áudio já é suspeito
+        minimo = (estimar_tamanho(duracao, job["perfil"]) - SOBRECARGA_ARQUIVO) // 2 if duracao else 0
+        decodificar = random.random() < float(self.config["verificar_amostra"])
+        # Com silêncio aparado, ser mais curta que a música é esperado
+        esperada = 0 if job["opcoes"]["aparar_silencio"] else duracao
+        pool = self.verificacoes
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                pool, verificar_arquivo, arquivo, job["config"]["ffmpeg"],
+                esperada, minimo, decodificar)
+        except concurrent.futures.BrokenExecutor:
+            # Um processo do pool morreu: o pool quebrado recusaria toda
+            # verificação seguinte, então é trocado; esta música passa sem ela
+            if self.verificacoes is pool:
+                pool.shutdown(wait=False, cancel_futures=True)
+                self.verificacoes = ProcessPoolExecutor(int(self.config["verificacoes_simultaneas"]))
+            self._emitir(job["id"], "log", texto=(
+                f"⚠️ {_nome_musica(musica)}: verificação interrompida, arquivo aceito sem ela"))
+            return ""
+
+    def _repassar(self, job_id: int, evento: dict, **extra):
+        """Traduz um evento do worker num evento da interface."""
+        if evento["tipo"] == "progresso":
+            self._emitir(job_id, "progresso", progresso=evento["progresso"],
+                         mensagem=evento["mensagem"], **extra)
+        elif evento["tipo"] == "log":
+            self._emitir(job_id, "log", texto=evento["texto"])
+
+    async def _executar_cli(self, job: dict) -> tuple:
+        """Executa o job com um processo spotdl novo (sem worker)."""
+        perfil = job["perfil"]
+        ffmpeg = job["config"]["ffmpeg"]
+        cmd = [
+            self.spotdl_cli or 'spotdl',
+            job["url"],
+            # Layout do job; "prefixo" depende de cada música e aqui fica plano
+            '--output', job["config"]["output"],
+        ] + argumentos_perfil(perfil, ffmpeg if ffmpeg != "ffmpeg" else None)
+        self._emitir(job["id"], "log", texto=f"💻 Comando: {' '.join(cmd)}")
+
+        processo = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            **_opcoes_grupo_processo()
+        )
+        try:
+            # Ler output em tempo real
+            async for linha in processo.stdout:
+                texto = linha.decode("utf-8", errors="replace").strip()
+                if texto:
+                    self._emitir(job["id"], "log", texto=texto)
+            return_code = await processo.wait()
+        except asyncio.CancelledError:
+            job["encerramentos"].append(asyncio.ensure_future(encerrar_arvore_processos(
+                processo, float(self.config["espera_cancelamento_s"]))))
+            raise
+        return return_code, f"Código de saída: {return_code}"
+
+
+if __name__ == "__main__":
+    executar_worker()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Os testes importam o motor direto da pasta do app (versão portátil, sem pacote)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
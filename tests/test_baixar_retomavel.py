@@ -0,0 +1,239 @@
+"""Retomada de downloads (baixar_retomavel) contra um servidor HTTP local com Range."""
+
+import http.server
+import json
+import os
+import threading
+
+import pytest
+import requests
+
+import baixafy_motor
+
+
+class ServidorRange(http.server.BaseHTTPRequestHandler):
+    """Serve `conteudo` com ETag, Last-Modified, Range/If-Range e 416.
+
+    `cortar_em` derruba a próxima resposta que passar por esse offset.
+    ETag fraca nunca confere em If-Range; com `ignora_if_range`, qualquer
+    pedido com If-Range recebe 200 e o conteúdo inteiro.
+    """
+
+    protocol_version = "HTTP/1.1"
+    conteudo = b""
+    etag = '"v1"'
+    modificado = None
+    ignora_if_range = False
+    cortar_em = None
+    pedidos = []
+    portas = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        servidor = type(self)
+        servidor.pedidos.append((self.headers.get("Range"), self.headers.get("If-Range")))
+        servidor.portas.append(self.client_address[1])
+        total = len(servidor.conteudo)
+        faixa = self.headers.get("Range")
+        validador = self.headers.get("If-Range")
+        confere = validador is None or (
+            not servidor.ignora_if_range and validador in (servidor.etag, servidor.modificado)
+            and not validador.startswith("W/"))
+        inicio, fim = 0, total - 1
+        if faixa and confere:
+            inicio, _, ultimo = faixa.split("=")[1].partition("-")
+            inicio = int(inicio)
+            fim = min(int(ultimo), total - 1) if ultimo else total - 1
+            if inicio >= total:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{total}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {inicio}-{fim}/{total}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", servidor.etag)
+        if servidor.modificado:
+            self.send_header("Last-Modified", servidor.modificado)
+        self.send_header("Content-Length", str(fim + 1 - inicio))
+        self.end_headers()
+
+        corte = fim + 1
+        if servidor.cortar_em is not None and inicio < servidor.cortar_em <= fim:
+            corte, servidor.cortar_em = servidor.cortar_em, None
+            self.close_connection = True
+        self.wfile.write(servidor.conteudo[inicio:corte])
+
+
+@pytest.fixture
+def servidor(monkeypatch):
+    # Sem espera entre tentativas
+    monkeypatch.setattr(baixafy_motor.time, "sleep", lambda s: None)
+    manipulador = type("Manipulador", (ServidorRange,), {
+        "conteudo": os.urandom(300_000), "pedidos": [], "portas": []})
+    http_servidor = http.server.ThreadingHTTPServer(("127.0.0.1", 0), manipulador)
+    # Conexões que o cliente abandona no meio não são erro do teste
+    http_servidor.handle_error = lambda pedido, endereco: None
+    threading.Thread(target=http_servidor.serve_forever, args=(0.05,), daemon=True).start()
+    manipulador.url = f"http://127.0.0.1:{http_servidor.server_port}/faixa.webm"
+    yield manipulador
+    http_servidor.shutdown()
+    http_servidor.server_close()
+
+
+def test_retoma_apos_queda_da_conexao(servidor, tmp_path):
+    servidor.cortar_em = 120_000
+
+    destino = baixafy_motor.baixar_retomavel(servidor.url, tmp_path / "faixa.webm")
+
+    assert destino.read_bytes() == servidor.conteudo
+    assert servidor.pedidos == [(None, None), ("bytes=120000-", '"v1"')]
+    assert not (tmp_path / "faixa.webm.parcial").exists()
+    assert not (tmp_path / "faixa.webm.parcial.json").exists()
+
+
+def test_retoma_parcial_de_execucao_anterior(servidor, tmp_path):
+    servidor.cortar_em = 50_000
+    with pytest.raises(ConnectionError):
+        baixafy_motor.baixar_retomavel(servidor.url, tmp_path / "faixa.webm", tentativas=1)
+    assert (tmp_path / "faixa.webm.parcial").stat().st_size == 50_000
+
+    destino = baixafy_motor.baixar_retomavel(servidor.url, tmp_path / "faixa.webm")
+
+    assert destino.read_bytes() == servidor.conteudo
+    assert servidor.pedidos[-1] == ("bytes=50000-", '"v1"')
+
+
+def test_if_range_divergente_recomeca_do_zero(servidor, tmp_path):
+    servidor.cortar_em = 50_000
+    with pytest.raises(ConnectionError):
+        baixafy_motor.baixar_retomavel(servidor.url, tmp_path / "faixa.webm", tentativas=1)
+
+    # A fonte mudou: o servidor ignora o Range e devolve o conteúdo novo inteiro
+    servidor.conteudo = os.urandom(200_000)
+    servidor.etag = '"v2"'
+    destino = baixafy_motor.baixar_retomavel(servidor.url, tmp_path / "faixa.webm")
+
+    assert destino.read_bytes() == servidor.conteudo
+    assert servidor.pedidos[-1] == ("bytes=50000-", '"v1"')
+
+
+def test_416_com_parcial_completo_conclui(servidor, tmp_path):
+    (tmp_path / "faixa.webm.parcial").write_bytes(servidor.conteudo)
+    (tmp_path / "faixa.webm.parcial.json").write_text(json.dumps(
+        {"etag": servidor.etag, "last_modified": None, "tamanho": len(servidor.conteudo)}))
+
+    destino = baixafy_motor.baixar_retomavel(servidor.url, tmp_path / "faixa.webm")
+
+    assert destino.read_bytes() == servidor.conteudo
+    assert servidor.pedidos == [(f"bytes={len(servidor.conteudo)}-", '"v1"')]
+    assert not (tmp_path / "faixa.webm.parcial.json").exists()
+
+
+def test_416_com_parcial_incompleto_falha(servidor, tmp_path):
+    # Parcial do tamanho errado para a fonte atual: 416 não pode virar sucesso
+    (tmp_path / "faixa.webm.parcial").write_bytes(servidor.conteudo + b"\0" * 10)
+    (tmp_path / "faixa.webm.parcial.json").write_text(json.dumps(
+        {"etag": servidor.etag, "last_modified": None, "tamanho": len(servidor.conteudo) + 20}))
+
+    with pytest.raises(requests.HTTPError):
+        baixafy_motor.baixar_retomavel(servidor.url, tmp_path / "faixa.webm")
+    assert not (tmp_path / "faixa.webm").exists()
+
+
+def test_sessao_reaproveita_a_conexao(servidor, tmp_path):
+    sessao = baixafy_motor.nova_sessao_http()
+
+    for nome in ("a.webm", "b.webm", "c.webm"):
+        destino = baixafy_motor.baixar_retomavel(servidor.url, tmp_path / nome, sessao=sessao)
+        assert destino.read_bytes() == servidor.conteudo
+
+    assert len(servidor.portas) == 3
+    assert len(set(servidor.portas)) == 1
+
+
+def _faixas(servidor) -> list:
+    """Ranges pedidos depois da sonda de 1 byte."""
+    return [faixa for faixa, _ in servidor.pedidos if faixa != "bytes=0-0"]
+
+
+def test_segmentado_baixa_faixas_em_paralelo(servidor, tmp_path):
+    destino = baixafy_motor.baixar_retomavel(
+        servidor.url, tmp_path / "faixa.webm", segmentos=4, segmento_min=50_000)
+
+    assert destino.read_bytes() == servidor.conteudo
+    assert servidor.pedidos[0] == ("bytes=0-0", None)
+    assert sorted(_faixas(servidor)) == sorted([
+        "bytes=0-74999", "bytes=75000-149999", "bytes=150000-224999", "bytes=225000-299999"])
+    assert {validador for _, validador in servidor.pedidos[1:]} == {'"v1"'}
+    assert not (tmp_path / "faixa.webm.parcial.json").exists()
+
+
+def test_segmentado_arquivo_pequeno_usa_uma_conexao(servidor, tmp_path):
+    destino = baixafy_motor.baixar_retomavel(
+        servidor.url, tmp_path / "faixa.webm", segmentos=4, segmento_min=200_000)
+
+    assert destino.read_bytes() == servidor.conteudo
+    assert servidor.pedidos == [("bytes=0-0", None), (None, None)]
+
+
+def test_segmentado_retoma_faixa_apos_queda(servidor, tmp_path):
+    servidor.cortar_em = 100_000
+
+    destino = baixafy_motor.baixar_retomavel(
+        servidor.url, tmp_path / "faixa.webm", segmentos=4, segmento_min=50_000)
+
+    assert destino.read_bytes() == servidor.conteudo
+    assert "bytes=100000-149999" in _faixas(servidor)
+    assert len(_faixas(servidor)) == 5
+
+
+def test_parcial_segmentado_retomado_com_uma_conexao(servidor, tmp_path):
+    # Regressão: um parcial segmentado (pré-alocado) retomado com segmentos=1
+    # virava um download simples a partir do fim do arquivo, com 416 e zeros
+    servidor.cortar_em = 100_000
+    with pytest.raises(ConnectionError):
+        baixafy_motor.baixar_retomavel(
+            servidor.url, tmp_path / "faixa.webm", segmentos=4, segmento_min=50_000,
+            tentativas=1)
+    meta = json.loads((tmp_path / "faixa.webm.parcial.json").read_text())
+    faltando = sorted(f"bytes={inicio + feito}-{fim}"
+                      for inicio, fim, feito in meta["segmentos"] if inicio + feito <= fim)
+    assert "bytes=100000-149999" in faltando
+    servidor.pedidos.clear()
+
+    destino = baixafy_motor.baixar_retomavel(servidor.url, tmp_path / "faixa.webm")
+
+    assert destino.read_bytes() == servidor.conteudo
+    assert sorted(faixa for faixa, _ in servidor.pedidos) == faltando
+    assert {validador for _, validador in servidor.pedidos} == {'"v1"'}
+
+
+def test_segmentado_com_etag_fraca_usa_last_modified(servidor, tmp_path):
+    servidor.etag = 'W/"v1"'
+    servidor.modificado = "Wed, 01 Jan 2025 00:00:00 GMT"
+
+    destino = baixafy_motor.baixar_retomavel(
+        servidor.url, tmp_path / "faixa.webm", segmentos=4, segmento_min=50_000)
+
+    assert destino.read_bytes() == servidor.conteudo
+    assert len(servidor.pedidos) == 5
+    assert {validador for _, validador in servidor.pedidos[1:]} == {servidor.modificado}
+
+
+def test_segmentado_sem_if_range_cai_para_uma_conexao(servidor, tmp_path):
+    # Sonda responde 206, mas toda faixa com If-Range volta 200: recomeça
+    # por faixas uma vez e depois baixa pela conexão única
+    servidor.ignora_if_range = True
+
+    destino = baixafy_motor.baixar_retomavel(
+        servidor.url, tmp_path / "faixa.webm", segmentos=4, segmento_min=50_000)
+
+    assert destino.read_bytes() == servidor.conteudo
+    assert servidor.pedidos.count(("bytes=0-0", None)) == 2
+    assert servidor.pedidos[-1] == (None, None)
+    assert len(servidor.pedidos) <= 11
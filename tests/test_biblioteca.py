@@ -0,0 +1,228 @@
+"""Índice da biblioteca (Biblioteca) num banco SQLite temporário."""
+
+import os
+import sqlite3
+
+import pytest
+
+import baixafy_motor
+
+
+@pytest.fixture
+def biblioteca(tmp_path):
+    bib = baixafy_motor.Biblioteca(tmp_path / "biblioteca.db")
+    yield bib
+    bib.fechar()
+
+
+def _arquivo(pasta, nome: str) -> str:
+    """Cria um arquivo de áudio falso e devolve o caminho absoluto."""
+    pasta.mkdir(parents=True, exist_ok=True)
+    (pasta / nome).write_bytes(os.urandom(64))
+    return str(pasta / nome)
+
+
+def _musica(song_id: str, nome: str = "Canção do Mar", artistas=("Dulce Pontes",),
+            album: str = "Lágrimas", isrc: str = None, duracao: int = 200) -> dict:
+    """Música como o spotdl serializa (só os campos que o índice usa)."""
+    return {"song_id": song_id, "name": nome, "artists": list(artistas),
+            "album_name": album, "isrc": isrc, "duration": duracao}
+
+
+def _dados(caminho: str, hash_: str, titulo: str = None, artistas: str = None,
+           duracao: int = None) -> dict:
+    """Tags e hash como a adoção lê de um arquivo."""
+    return {"caminho": caminho, "hash": hash_, "titulo": titulo, "artistas": artistas,
+            "album": None, "isrc": None, "duracao": duracao}
+
+
+def _varrer(biblioteca, raiz, *caminhos):
+    """Coloca arquivos no índice como a varredura (sem metadados)."""
+    biblioteca.gravar_pasta(str(raiz), str(raiz), None, 0, [(c, 64, 0) for c in caminhos])
+
+
+def test_possui_pelo_id_na_mesma_pasta_e_formato(biblioteca, tmp_path):
+    raiz = tmp_path / "musicas"
+    caminho = _arquivo(raiz, "a.mp3")
+    biblioteca.registrar(str(raiz), caminho, _musica("id1"))
+
+    assert biblioteca.possui(_musica("id1"), str(raiz), "mp3") == caminho
+    assert biblioteca.possui(_musica("id1"), str(raiz), "m4a") is None
+    assert biblioteca.possui(_musica("id1"), str(tmp_path / "outra"), "mp3") is None
+    assert biblioteca.possui(_musica("id2", nome="Outra"), str(raiz), "mp3") is None
+
+    os.remove(caminho)
+    assert biblioteca.possui(_musica("id1"), str(raiz), "mp3") is None
+
+
+def test_possui_por_tags_de_arquivo_adotado(biblioteca, tmp_path):
+    # Arquivo sem match no Spotify: vale pelas tags normalizadas e duração
+    raiz = tmp_path / "antiga"
+    caminho = _arquivo(raiz, "x.mp3")
+    _varrer(biblioteca, raiz, caminho)
+    biblioteca.identificar([(_dados(caminho, "h1", "Canção do Mar (Remastered)",
+                                    "Dulce Pontes, Outro", 201), None)])
+
+    parecida = _musica("id9", nome="cancao do mar", artistas=("DULCE PONTES",), duracao=199)
+    assert biblioteca.possui(parecida, str(tmp_path / "nova"), "m4a") == caminho
+    assert biblioteca.possui(dict(parecida, duration=210), str(tmp_path / "nova"), "m4a") is None
+
+
+def test_registrar_aponta_duplicatas_de_outras_pastas(biblioteca, tmp_path):
+    pc, pendrive = tmp_path / "pc", tmp_path / "pendrive"
+    a = _arquivo(pc, "a.mp3")
+    b = _arquivo(pendrive, "b.m4a")
+    c = _arquivo(pendrive, "c.mp3")
+    d = _arquivo(pendrive, "d.mp3")
+    e = _arquivo(pendrive, "e.mp3")
+
+    assert biblioteca.registrar(str(pc), a, _musica("id1", isrc="BR1")) == []
+    assert set(biblioteca.registrar(str(pendrive), b, _musica("id1", isrc="BR1"))) == {
+        (a, "spotify"), (a, "isrc"), (a, "tags")}
+    assert set(biblioteca.registrar(str(pendrive), c, _musica("id2", nome="Outra", isrc="BR1"))) == {
+        (a, "isrc"), (b, "isrc")}
+    assert set(biblioteca.registrar(str(pendrive), d, _musica("id3", nome="Canção do Mar - Live",
+                                                              duracao=202))) == {
+        (a, "tags"), (b, "tags")}
+    assert biblioteca.registrar(str(pendrive), e, _musica("id4", duracao=210)) == []
+
+
+def test_identificar_gera_os_pares_do_lote(biblioteca, tmp_path):
+    raiz = tmp_path / "antiga"
+    x, y, z = (_arquivo(raiz, nome) for nome in ("x.mp3", "y.mp3", "z.mp3"))
+    _varrer(biblioteca, raiz, x, y, z)
+
+    biblioteca.identificar([
+        (_dados(x, "h1", "Canção do Mar", "Dulce Pontes", 200), None),
+        (_dados(y, "h1", "Outra", "Alguém", 100), _musica("id5", nome="Outra", artistas=("Alguém",),
+                                                        duracao=100)),
+        (_dados(z, "h2", "Cancao do Mar (Ao Vivo)", "dulce pontes", 202),
+         _musica("id5", nome="Outra", artistas=("Alguém",), duracao=100)),
+    ])
+
+    assert biblioteca.duplicatas(str(raiz)) == [
+        (x, y, "hash", 0), (y, z, "spotify", 0), (y, z, "tags", 0)]
+
+    # Reidentificar com outro hash refaz os pares do arquivo
+    biblioteca.identificar([(_dados(y, "h3"), None)])
+    assert biblioteca.duplicatas(str(raiz)) == [(y, z, "spotify", 0), (y, z, "tags", 0)]
+
+
+def _banco_antigo(caminho, raiz, *linhas):
+    """Banco com o esquema original de `arquivos` (user_version 0)."""
+    conexao = sqlite3.connect(str(caminho))
+    conexao.execute(
+        "CREATE TABLE arquivos (caminho TEXT PRIMARY KEY, raiz TEXT NOT NULL, song_id TEXT, "
+        "formato TEXT, titulo TEXT, artistas TEXT, album TEXT, isrc TEXT, duracao REAL, "
+        "tamanho INTEGER, mtime_ns INTEGER, adicionado REAL)")
+    conexao.executemany(
+        "INSERT INTO arquivos VALUES (?, ?, ?, 'mp3', ?, ?, NULL, NULL, ?, 64, 0, 0)",
+        [(caminho_arquivo, str(raiz), *resto) for caminho_arquivo, *resto in linhas])
+    conexao.commit()
+    conexao.close()
+
+
+def test_migra_banco_do_esquema_antigo(tmp_path):
+    raiz = tmp_path / "musicas"
+    a = _arquivo(raiz, "a.mp3")
+    b = _arquivo(raiz / "sub", "b.mp3")
+    _banco_antigo(tmp_path / "biblioteca.db", raiz,
+                  (a, "id1", "Canção do Mar", "Dulce Pontes", 200),
+                  (b, "id2", "Cancao do Mar", "Dulce Pontes", 201))
+
+    bib = baixafy_motor.Biblioteca(tmp_path / "biblioteca.db")
+    try:
+        assert bib.possui(_musica("id1"), str(raiz), "mp3") == a
+        assert bib.duplicatas(str(raiz)) == [(a, b, "tags", 1)]
+    finally:
+        bib.fechar()
+    conexao = sqlite3.connect(str(tmp_path / "biblioteca.db"))
+    assert conexao.execute("PRAGMA user_version").fetchone()[0] == len(
+        baixafy_motor.Biblioteca.MIGRACOES)
+    assert conexao.execute("SELECT pasta FROM arquivos WHERE caminho = ?", (b,)).fetchone() == (
+        str(raiz / "sub"),)
+    conexao.close()
+
+    # Reabrir não reaplica migração nenhuma
+    baixafy_motor.Biblioteca(tmp_path / "biblioteca.db").fechar()
+
+
+def test_migracao_que_falha_nao_fica_pela_metade(tmp_path):
+    baixafy_motor.Biblioteca(tmp_path / "biblioteca.db").fechar()
+
+    class Quebrada(baixafy_motor.Biblioteca):
+        MIGRACOES = baixafy_motor.Biblioteca.MIGRACOES + [
+            "ALTER TABLE arquivos ADD COLUMN nova TEXT;"
+            "UPDATE tabela_que_nao_existe SET x = 1;"]
+
+    with pytest.raises(sqlite3.OperationalError):
+        Quebrada(tmp_path / "biblioteca.db")
+
+    conexao = sqlite3.connect(str(tmp_path / "biblioteca.db"))
+    assert conexao.execute("PRAGMA user_version").fetchone()[0] == len(
+        baixafy_motor.Biblioteca.MIGRACOES)
+    assert "nova" not in [coluna[1] for coluna in conexao.execute("PRAGMA table_info(arquivos)")]
+    conexao.close()
+
+
+def _nomes(resultados) -> set:
+    return {os.path.basename(caminho) for caminho, *_ in resultados}
+
+
+def test_buscar_ignora_acentos_e_caixa_e_aceita_prefixos(biblioteca, tmp_path):
+    raiz = tmp_path / "musicas"
+    biblioteca.registrar(str(raiz), _arquivo(raiz, "a.mp3"), _musica("id1"))
+    biblioteca.registrar(str(raiz), _arquivo(raiz, "b.mp3"), _musica(
+        "id2", nome="Ela é Carioca", artistas=("Tom Jobim", "Vinícius"), album="Getz/Gilberto"))
+
+    assert _nomes(biblioteca.buscar("cancao")) == {"a.mp3"}
+    assert _nomes(biblioteca.buscar("CANÇÃO mar")) == {"a.mp3"}
+    assert _nomes(biblioteca.buscar("dul pon lagri")) == {"a.mp3"}
+    assert _nomes(biblioteca.buscar("vinicius")) == {"b.mp3"}
+    assert _nomes(biblioteca.buscar("gilb")) == {"b.mp3"}
+    assert biblioteca.buscar("cancao jobim") == []
+    assert biblioteca.buscar("  ?! ") == []
+
+
+def test_buscar_por_nome_de_playlist(biblioteca, tmp_path):
+    raiz = tmp_path / "musicas"
+    biblioteca.registrar(str(raiz), _arquivo(raiz, "a.mp3"), _musica("id1"))
+    # Playlist registrada depois da música e antes dela (arquivo ainda por vir)
+    biblioteca.registrar_playlist("https://open.spotify.com/playlist/p1", "Fado Clássico",
+                                  ["id1", "id2"])
+    biblioteca.registrar(str(raiz), _arquivo(raiz, "b.mp3"), _musica("id2", nome="Barco Negro"))
+    biblioteca.registrar_playlist("https://open.spotify.com/playlist/p2", "Viagem", ["id2"])
+
+    assert _nomes(biblioteca.buscar("classico")) == {"a.mp3", "b.mp3"}
+    assert _nomes(biblioteca.buscar("fado viag")) == {"b.mp3"}
+
+
+def test_busca_acompanha_reregistro_e_remocao(biblioteca, tmp_path):
+    # INSERT OR REPLACE só apaga a linha antiga da busca com recursive_triggers
+    raiz = tmp_path / "musicas"
+    caminho = _arquivo(raiz, "a.mp3")
+    biblioteca.registrar(str(raiz), caminho, _musica("id1"))
+    biblioteca.registrar(str(raiz), caminho, _musica("id1"))
+    biblioteca.registrar(str(raiz), caminho, _musica("id1", nome="Barco Negro"))
+
+    assert biblioteca.buscar("cancao") == []
+    assert _nomes(biblioteca.buscar("barco")) == {"a.mp3"}
+    conexao = sqlite3.connect(str(tmp_path / "biblioteca.db"))
+    assert conexao.execute("SELECT count(*) FROM busca").fetchone()[0] == 1
+
+    biblioteca.remover(caminho)
+    assert biblioteca.buscar("barco") == []
+    assert conexao.execute("SELECT count(*) FROM busca").fetchone()[0] == 0
+    conexao.close()
+
+
+def test_migracao_preenche_a_busca(tmp_path):
+    raiz = tmp_path / "musicas"
+    _banco_antigo(tmp_path / "biblioteca.db", raiz,
+                  (_arquivo(raiz, "a.mp3"), "id1", "Canção do Mar", "Dulce Pontes", 200))
+
+    bib = baixafy_motor.Biblioteca(tmp_path / "biblioteca.db")
+    try:
+        assert _nomes(bib.buscar("cancao dulce")) == {"a.mp3"}
+    finally:
+        bib.fechar()